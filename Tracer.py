@@ -25,3 +25,27 @@ def example1(width = 200, height = 150):
     image = Image.fromarray(render)
     print('time taken:', time.perf_counter()-t0)
     image.save('result.png')
+
+
+
+# Постепенная отрисовка той же сцены: после каждого прохода сохраняется промежуточный кадр
+def example1_progressive(width = 200, height = 150, passes = (8, 4, 2, 1)):
+    t0 = time.perf_counter()
+
+    ball1 = Sphere(3).coloured(Colour.RGB(0.9,0.3,0)).apply(Mat4.Translator(3,-1,-2))
+    ball2 = Sphere(2).coloured(Colour.RGB(0,0.6,0.6)).apply(Mat4.Translator(-2,2,-4))
+    ball3 = Sphere().coloured(Colour.RGB(0.7,1,0)).apply(Mat4.Translator(-2,0,1))
+
+    eye = Eye(transform = Mat4.Translator(0,0,4))
+    light = PointSource(Vec4.Point(0,6,6), Colour.RGB(1.2,1.2,1.2))
+
+    scene = Scene([ball1, ball2, ball3], light, eye)
+
+    render = np.zeros((height, width, 3), np.uint8)
+    step = 0
+    for rect, pixels in eye.render_iter(scene, width, height, 64, passes, render):
+        # Последняя плитка прохода завершает очередной промежуточный кадр
+        if rect[2:] == (width, height):
+            Image.fromarray(render).save(f'result_pass{passes[step]}.png')
+            print('pass', passes[step], 'time taken:', time.perf_counter()-t0)
+            step += 1
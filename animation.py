@@ -0,0 +1,326 @@
+from bodies import Body
+from bvh import inverse_dirs, padded, slab_arrays
+from gbuffer import Layer
+from lights import LightSource
+from optics import light_layers, quantise
+from spatial import *
+from utils import *
+
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import os
+import pickle
+
+
+
+# Пересечение лучей (n,4) с параметрами t из [0, tmax] хотя бы одного из параллелепипедов boxes (m,2,3)
+def crossing(origins, directions, boxes, tmax, chunk = 1 << 16):
+    result = np.zeros(len(origins), bool)
+    inv_dirs = inverse_dirs(directions)
+    tmax = np.broadcast_to(tmax, (len(origins),))
+    step = max(1, chunk//len(boxes))
+    for i in range(0, len(origins), step):
+        tnear, tfar = slab_arrays(origins[i:i+step,None,:3], inv_dirs[i:i+step,None], boxes[:,0], boxes[:,1])
+        result[i:i+step] = np.any((tnear <= tfar) & (tfar >= 0.0) & (tnear <= tmax[i:i+step,None]), axis = 1)
+    return result
+
+# Слой из записей layer с маской keep
+def select(layer, keep):
+    return Layer(*(getattr(layer, field)[keep] for field in Layer.fields))
+
+
+
+# Покадровые матрицы положения камеры или тела по ключевым положениям keys - парам (точка (3,), Versor)
+# либо матрицам Mat4 из поворота и переноса (масштаб ключей не учитывается); кадры count делят путь поровну
+# smooth - squad для поворотов и сплайн Катмулла-Рома для точек, иначе slerp и линейная интерполяция
+# Матрицы всех кадров считаются одним проходом по массивам и несут свои обратные
+def camera_path(keys, count, smooth = True):
+    positions, rotations = [], []
+    for key in keys:
+        if isinstance(key, Mat4):
+            positions.append(key.data[3,:3])
+            rotations.append(quat_from_matrices(key.data))
+        else:
+            positions.append(np.asarray(key[0], float)[:3])
+            rotations.append(key[1].data)
+    if len(keys) == 1:
+        positions, rotations = positions*2, rotations*2
+    positions = np.array(positions)
+    rotations, controls = squad_controls(rotations)
+    last = len(positions)-1
+    u = np.linspace(0.0, last, count)
+    i = np.minimum(u.astype(int), last-1)
+    t = (u-i)[:,None]
+    p1, p2 = positions[i], positions[i+1]
+    if smooth:
+        q = squad(rotations[i], rotations[i+1], controls[i], controls[i+1], t[:,0])
+        p0, p3 = positions[np.maximum(i-1, 0)], positions[np.minimum(i+2, last)]
+        p = 0.5*(2.0*p1+(p2-p0)*t+(2.0*p0-5.0*p1+4.0*p2-p3)*t**2+(3.0*(p1-p2)+p3-p0)*t**3)
+    else:
+        q = slerp(rotations[i], rotations[i+1], t[:,0])
+        p = p1+(p2-p1)*t
+    matrices = quat_to_matrices(q)
+    matrices[:,3,:3] = p
+    # Обратная: транспонированный поворот и перенос на -p, повёрнутый им же
+    inverses = np.zeros_like(matrices)
+    inverses[:,:3,:3] = np.swapaxes(matrices[:,:3,:3], 1, 2)
+    inverses[:,3,:3] = -np.matmul(p[:,None], inverses[:,:3,:3])[:,0]
+    inverses[:,3,3] = 1.0
+    return [Mat4(m, inv) for m, inv in zip(matrices, inverses)]
+
+# Обновления для Animation, проводящие тело или камеру body по абсолютным матрицам transforms:
+# преобразование кадра - переход от прошлой матрицы к следующей, M_prev^-1 M_next
+def path_updates(body, transforms):
+    current = Mat4(body.transform.copy(), body.inv_transform.copy())
+    updates = []
+    for transform in transforms:
+        updates.append([(body, Mat4(np.matmul(current.inverse, transform.data), np.matmul(transform.inverse, current.data)))])
+        current = transform
+    return updates
+
+
+
+# Анимация сцены: перед каждым кадром к телам, камере и источникам применяются преобразования
+# updates - список по кадрам из списков пар (цель, Mat4) или функция номера кадра, возвращающая такой список
+# Цель - тело сцены или его номер, камера сцены или 'camera', источник света или ('light', j),
+# весь свет сцены - scene.light или 'light'
+# Между кадрами переиспользуется всё, что осталось верным: лучи камеры, пока она неподвижна,
+# иерархия объёмов (пересчёт границ вместо перестройки) и пиксели, пути лучей которых
+# (первичные, отражённые и теневые) не проходят через старые и новые границы сдвинутых тел;
+# при движении одних источников геометрия кадра переосвещается без поиска пересечений
+class Animation:
+    width : int
+    height : int
+    count : int
+    frame : int
+    # Выключенный режим отрисовывает каждый кадр заново, для сравнения
+    incremental = True
+    # Ограничение на размер промежуточных массивов (лучи * параллелепипеды)
+    chunk = 1 << 16
+
+    # count - число кадров, для функции updates обязательно
+    def __init__(self, scene, width, height, updates, count = None):
+        self.scene = scene
+        self.width = width
+        self.height = height
+        if callable(updates):
+            self.updates = updates
+            self.count = count
+        else:
+            # Цели списка переводятся в ключи, чтобы снимок анимации можно было передать другому процессу
+            self.updates = [[(self.resolve(target), transform) for target, transform in frame] for frame in updates]
+            self.count = len(self.updates) if count is None else count
+        self.frame = 0
+        self.batch = None
+        self.layers = None
+        self.image = None
+        # Число пересчитанных пикселей последнего кадра
+        self.retraced = 0
+
+    # Ключ цели преобразования: ('body', i), ('camera',), ('light',) или ('light', j)
+    def resolve(self, target):
+        if isinstance(target, tuple):
+            return target
+        if isinstance(target, (int, np.integer)):
+            return ('body', int(target))
+        if target == 'camera' or target is self.scene.camera:
+            return ('camera',)
+        if target == 'light' or target is self.scene.light:
+            return ('light',)
+        if isinstance(target, Body):
+            for i, b in enumerate(self.scene.bodies):
+                if b is target:
+                    return ('body', i)
+        if isinstance(target, LightSource):
+            for j, source in enumerate(self.scene.lights.sources):
+                if source is target:
+                    return ('light', j)
+        raise ValueError(f'animation target {target!r} is not part of the scene')
+
+    def frame_updates(self, k):
+        if callable(self.updates):
+            return [(self.resolve(target), transform) for target, transform in self.updates(k)]
+        return self.updates[k] if k < len(self.updates) else []
+
+    # Применение преобразований кадра k
+    # Возвращает параллелепипеды (m,2,3) сдвинутых тел до и после преобразований, номера этих тел
+    # и признаки того, что сдвинулись камера и источники
+    def apply_updates(self, k):
+        before = {}
+        camera = lights = False
+        for key, transform in self.frame_updates(k):
+            if key[0] == 'body':
+                body = self.scene.bodies[key[1]]
+                if key[1] not in before:
+                    before[key[1]] = body.world_bounds()
+                body.apply(transform)
+            elif key[0] == 'camera':
+                self.scene.camera.apply(transform)
+                camera = True
+            elif len(key) == 1:
+                self.scene.light.apply(transform)
+                lights = True
+            else:
+                # Упакованные положения набора источников обновляются вместе с источником
+                pack = self.scene.lights
+                pack.sources[key[1]].apply(transform)
+                if len(pack) > 1:
+                    pack.positions[key[1]] = pack.sources[key[1]].position.data
+                lights = True
+        moved = list(before)
+        boxes = [before[i] for i in moved]+[self.scene.bodies[i].world_bounds() for i in moved]
+        return np.array(boxes).reshape((-1, 2, 3)), moved, camera, lights
+
+    # Переход к кадру k без отрисовки: преобразования пропущенных кадров применяются подряд
+    def seek(self, k):
+        while self.frame < k:
+            self.apply_updates(self.frame)
+            self.frame += 1
+        self.scene.invalidate()
+        self.batch = None
+        self.layers = None
+        self.image = None
+
+    # Отрисовка следующего кадра, результат - изображение (height, width, 3) в байтах
+    def step(self):
+        scene = self.scene
+        eye = scene.camera
+        boxes, moved, camera, lights = self.apply_updates(self.frame)
+        self.frame += 1
+        scene.update(moved)
+        n = self.width*self.height
+        if camera or self.batch is None or not self.incremental:
+            self.batch = eye.GridIterator(eye, self.width, self.height).ray_batch()
+        shadows = scene if eye.shadows else None
+        if camera or self.layers is None or not self.incremental or not np.all(np.isfinite(boxes)):
+            self.layers = eye.geometry_batch(scene, self.batch, screen = (self.width, self.height, (0, 0, self.width, self.height)))
+            lights = True
+            self.retraced = n
+        elif len(boxes):
+            idx = np.nonzero(self.affected(boxes))[0]
+            self.retraced = len(idx)
+            layers = self.retrace(idx)
+            if not lights and len(idx):
+                colours = light_layers(layers, scene.light, n, shadows)
+                self.image.reshape((-1, 3))[idx] = quantise(colours[idx])
+        else:
+            self.retraced = 0
+        if lights:
+            colours = light_layers(self.layers, scene.light, n, shadows)
+            self.image = quantise(colours).reshape((self.height, self.width, 3))
+        return self.image.copy()
+
+    # Генератор изображений оставшихся кадров
+    # backend = 'parallel' распределяет кадры по workers процессам подряд идущими отрезками,
+    # внутри которых кадры переиспользуют друг друга; updates-функция тогда должна передаваться
+    # в другой процесс, то есть быть функцией уровня модуля и возвращать ключи целей
+    def frames(self, backend = 'batch', workers = None):
+        if backend == 'parallel':
+            yield from self.frames_parallel(workers)
+        elif backend == 'batch':
+            while self.frame < self.count:
+                yield self.step()
+        else:
+            raise ValueError(f'unknown animation backend: {backend}')
+
+    def frames_parallel(self, workers = None):
+        workers = workers or os.cpu_count()
+        start = self.frame
+        size = max(1, -(-(self.count-start)//workers))
+        snapshot = copy.copy(self)
+        snapshot.batch = snapshot.layers = snapshot.image = None
+        with ProcessPoolExecutor(workers, initializer = init_frames, initargs = (pickle.dumps(snapshot),)) as executor:
+            futures = [executor.submit(render_frames, k, min(k+size, self.count)) for k in range(start, self.count, size)]
+            for future in futures:
+                yield from future.result()
+        # Сцена приводится к состоянию после последнего кадра, как при последовательной отрисовке
+        self.seek(self.count)
+
+    # Маска пикселей, результат которых могли изменить тела в параллелепипедах boxes
+    # Первичные лучи проверяются только в экранных границах параллелепипедов и до своего попадания,
+    # остальные отрезки путей восстанавливаются по слоям прошлого кадра
+    def affected(self, boxes):
+        scene = self.scene
+        eye = scene.camera
+        boxes = padded(boxes)
+        margin = 10.0*offset(self.batch.dtype)*(1.0+np.abs(boxes))
+        boxes = np.stack((boxes[:,0]-margin[:,0], boxes[:,1]+margin[:,1]), axis = 1)
+        n = len(self.batch)
+        dirty = np.zeros(n, bool)
+        first = np.full(n, np.inf)
+        if self.layers:
+            first[self.layers[0].pixel] = self.layers[0].t
+        idx = self.screen_pixels(boxes)
+        dirty[idx] = crossing(self.batch.origins[idx], self.batch.directions[idx], boxes, first[idx], self.chunk)
+        reflectivity = scene.reflectivities()
+        positions = scene.lights.positions
+        for depth, layer in enumerate(self.layers):
+            points = layer.position.astype(float)
+            # Отражённый луч от точки отражения до попадания
+            if depth > 0:
+                dirty[layer.pixel] |= crossing(layer.origin, points-layer.origin, boxes, 1.0, self.chunk)
+            # Теневые лучи ко всем источникам
+            if eye.shadows:
+                for position in positions:
+                    dirty[layer.pixel] |= crossing(points, position-points, boxes, 1.0, self.chunk)
+            # Отражённые лучи, ушедшие мимо всех тел
+            if depth < eye.max_depth:
+                spawned = layer.weight*reflectivity[layer.body].astype(layer.weight.dtype) > eye.cutoff
+                following = self.layers[depth+1].pixel if depth+1 < len(self.layers) else ()
+                escaped = np.nonzero(spawned & ~np.isin(layer.pixel, following))[0]
+                dirs = reflect_arrays(points[escaped]-layer.origin[escaped], layer.normal[escaped].astype(float))
+                dirty[layer.pixel[escaped]] |= crossing(points[escaped], dirs, boxes, np.inf, self.chunk)
+        return dirty
+
+    # Номера пикселей в экранных границах параллелепипедов; параллелепипед, задевающий
+    # плоскость камеры, занимает весь кадр
+    def screen_pixels(self, boxes):
+        eye = self.scene.camera
+        boxes = np.asarray(boxes, float).reshape((-1, 2, 3))
+        # Восемь углов каждого параллелепипеда (K,8,4)
+        pick = np.array([(x, y, z) for x in (0, 1) for y in (0, 1) for z in (0, 1)])
+        corners = np.ones((len(boxes), 8, 4))
+        corners[:,:,:3] = boxes[:, pick, np.arange(3)]
+        local = np.matmul(corners, eye.inv_transform)
+        depth = -local[:,:,2]
+        if np.any(depth <= EPSILON):
+            return np.arange(self.width*self.height)
+        u, v = local[:,:,0]/depth, local[:,:,1]/depth
+        mask = np.zeros((self.height, self.width), bool)
+        for x0, y0, x1, y1 in eye.plane_rects((u.min(axis = 1), u.max(axis = 1)), (v.min(axis = 1), v.max(axis = 1)), self.width, self.height):
+            mask[y0:y1, x0:x1] = True
+        return np.nonzero(mask.reshape(-1))[0]
+
+    # Повторный геометрический проход для пикселей idx с заменой их записей в слоях кадра
+    # Возвращает новые слои этих пикселей
+    def retrace(self, idx):
+        eye = self.scene.camera
+        layers = eye.geometry_batch(self.scene, self.batch[idx]) if len(idx) else []
+        for layer in layers:
+            layer.pixel = idx[layer.pixel]
+        dirty = np.zeros(len(self.batch), bool)
+        dirty[idx] = True
+        merged = []
+        for depth in range(max(len(self.layers), len(layers))):
+            parts = []
+            if depth < len(self.layers):
+                parts.append(select(self.layers[depth], ~dirty[self.layers[depth].pixel]))
+            if depth < len(layers):
+                parts.append(layers[depth])
+            merged.append(Layer(*(np.concatenate([getattr(p, field) for p in parts]) for field in Layer.fields)))
+        self.layers = [layer for layer in merged if len(layer)]
+        return layers
+
+
+
+# Состояние процесса покадровой отрисовки: снимок анимации передаётся один раз при его запуске
+animation_state = {}
+
+def init_frames(snapshot):
+    animation_state['snapshot'] = snapshot
+
+# Изображения кадров start..end-1, отрисованных подряд с переиспользованием между ними
+def render_frames(start, end):
+    animation = pickle.loads(animation_state['snapshot'])
+    animation.seek(start)
+    return [animation.step() for _ in range(start, end)]
@@ -0,0 +1,260 @@
+from bodies import *
+from optics import *
+from scene import *
+from spatial import *
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+
+
+# Сцена из n случайных сфер перед камерой
+def random_spheres(n, seed = 0, spread = 10.0):
+    rng = np.random.default_rng(seed)
+    bodies = []
+    for (x, y, z), r, c in zip(rng.uniform(-spread, spread, (n, 3)),
+                               rng.uniform(0.05, 0.5, n)*spread/math.sqrt(max(n, 1))**(2/3),
+                               rng.uniform(0.2, 1.0, (n, 3))):
+        bodies.append(Sphere(r).coloured(Colour.RGB(*c)).apply(Mat4.Translator(x, y, z-2*spread)))
+    eye = Eye(transform = Mat4.Translator(0, 0, 0))
+    light = PointSource(Vec4.Point(0, 2*spread, 0), Colour.RGB(1.2, 1.2, 1.2))
+    return Scene(bodies, light, eye)
+
+# Вершины и грани UV-сферы единичного радиуса примерно из n граней
+def uv_sphere(n):
+    k = max(3, int(math.sqrt(n/2))+1)
+    theta, phi = np.meshgrid(np.linspace(0, math.pi, k), np.linspace(0, 2*math.pi, k), indexing = 'ij')
+    points = np.stack((np.sin(theta)*np.cos(phi), np.cos(theta), np.sin(theta)*np.sin(phi)), axis = -1).reshape((-1, 3))
+    i = (np.arange(k-1)[:,None]*k+np.arange(k-1)[None]).reshape(-1)
+    indices = np.concatenate((np.stack((i, i+k, i+1), axis = 1), np.stack((i+1, i+k, i+k+1), axis = 1)))
+    return points, indices
+
+# Сцена с треугольной сеткой примерно из n граней над полом
+def mesh_scene(n):
+    points, indices = uv_sphere(n)
+    mesh = Polyhedron(points, indices).coloured(Colour.RGB(0.8, 0.7, 0.3)).apply(Mat4.Scaler(2, 2, 2)*Mat4.Translator(0, 0, -5))
+    floor = Quad.Y_pos(20, 20).coloured(Colour.RGB(0.6, 0.6, 0.6)).apply(Mat4.Translator(0, -2, 0))
+    eye = Eye(transform = Mat4.Translator(0, 0, 1))
+    light = PointSource(Vec4.Point(-4, 6, 2), Colour.RGB(1.2, 1.2, 1.2))
+    return Scene([mesh, floor], light, eye)
+
+# Стена из n*n плиток-четырёхугольников
+def quad_scene(n):
+    bodies = []
+    size = 10.0/n
+    for i in range(n):
+        for j in range(n):
+            colour = Colour.RGB(0.3+0.6*((i+j) % 2), 0.5, 0.8-0.5*((i+j) % 2))
+            bodies.append(Quad.Z_pos(0.9*size, 0.9*size).coloured(colour)
+                          .apply(Mat4.Translator(-5+(i+0.5)*size, -5+(j+0.5)*size, -8)))
+    eye = Eye(transform = Mat4.Translator(0, 0, 0))
+    light = PointSource(Vec4.Point(0, 0, 2), Colour.RGB(1.2, 1.2, 1.2))
+    return Scene(bodies, light, eye)
+
+# Стена плиток, освещённая n источниками с ограниченным радиусом действия
+def lights_scene(n, seed = 0):
+    rng = np.random.default_rng(seed)
+    scene = quad_scene(20)
+    scene.light = Lights([PointSource(Vec4.Point(*p), Colour.RGB(*c), 2.0)
+                          for p, c in zip(rng.uniform((-5, -5, -7.5), (5, 5, -6), (n, 3)),
+                                          rng.uniform(0.3, 1.0, (n, 3)))])
+    return scene
+
+# Смешанная сцена из n тел с поворотами, неоднородным масштабом и сдвигами
+def mixed_scene(n, seed = 0):
+    rng = np.random.default_rng(seed)
+    bodies = []
+    for k in range(n):
+        x, y, z = rng.uniform(-8, 8, 3)
+        transform = (Mat4.Scaler(*rng.uniform(0.3, 1.0, 3))*Mat4.Shearer(xy = rng.uniform(-0.3, 0.3))
+                     *Mat4.Rotor(k % 3, rng.uniform(0, math.pi))*Mat4.Translator(x, y, z-20))
+        colour = Colour.RGB(*rng.uniform(0.2, 1.0, 3))
+        body = (Sphere(), Box(), Quad())[k % 3]
+        bodies.append(body.coloured(colour).apply(transform))
+    eye = Eye(transform = Mat4.Translator(0, 0, 0))
+    light = PointSource(Vec4.Point(0, 15, 0), Colour.RGB(1.2, 1.2, 1.2))
+    return Scene(bodies, light, eye)
+
+# Поле из n мелких сфер трёх цветов над полом
+def field_scene(n, seed = 0):
+    rng = np.random.default_rng(seed)
+    centres = np.column_stack((rng.uniform(-6, 6, (n, 2)), rng.uniform(-25, -3, n)))
+    palette = [Colour.RGB(0.9, 0.3, 0.2), Colour.RGB(0.2, 0.8, 0.3), Colour.RGB(0.3, 0.4, 0.9)]
+    field = SphereField(centres, rng.uniform(0.01, 0.05, n), rng.integers(0, 3, n), palette)
+    floor = Quad.Y_pos(40, 40).coloured(Colour.RGB(0.6, 0.6, 0.6)).apply(Mat4.Translator(0, -6, -14))
+    eye = Eye(transform = Mat4.Translator(0, 0, 0))
+    light = PointSource(Vec4.Point(0, 10, 0), Colour.RGB(1.2, 1.2, 1.2))
+    return Scene([field, floor], light, eye)
+
+# Наборы сцен: имя, конструктор и значение параметра
+SUITES = {
+    'quick' : [('spheres', random_spheres, 3), ('spheres', random_spheres, 100), ('spheres', random_spheres, 1000),
+               ('mesh', mesh_scene, 1000), ('quads', quad_scene, 10), ('lights', lights_scene, 100),
+               ('mixed', mixed_scene, 100), ('field', field_scene, 10000)],
+    'full' : [('spheres', random_spheres, 3), ('spheres', random_spheres, 100), ('spheres', random_spheres, 1000),
+              ('spheres', random_spheres, 10000), ('spheres', random_spheres, 100000),
+              ('mesh', mesh_scene, 1000), ('mesh', mesh_scene, 100000),
+              ('quads', quad_scene, 10), ('quads', quad_scene, 50), ('lights', lights_scene, 100),
+              ('lights', lights_scene, 1000), ('mixed', mixed_scene, 1000), ('field', field_scene, 100000),
+              ('field', field_scene, 1000000)],
+}
+
+
+
+# Лучшее время из repeat запусков функции
+def best_time(f, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = f()
+        best = min(best, time.perf_counter()-t0)
+    return best, result
+
+# Пиковая память одного отдельного запуска функции; tracemalloc сильно замедляет numpy,
+# поэтому замеры времени идут без него
+def peak_memory(f):
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Замеры одной сцены по стадиям и полной отрисовки на нескольких разрешениях
+def bench_scene(scene, resolutions, repeat = 3):
+    eye = scene.camera
+    width, height = resolutions[0]
+    grid = eye.GridIterator(eye, width, height)
+    t0 = time.perf_counter()
+    scene.invalidate()
+    scene.bvh
+    build = time.perf_counter()-t0
+    rays_time, batch = best_time(grid.ray_batch, repeat)
+    # Число проверок пары луч-тело при обходе иерархии
+    tests = [0]
+    def counting_test(prims, idx):
+        tests[0] += len(prims)*len(idx)
+        return scene.hit_bodies(prims, batch[idx])
+    scene.bvh.nearest_batch(batch, counting_test)
+    cast_time, hits = best_time(lambda : scene.cast_batch(batch), repeat)
+    origin = np.matmul(eye.origin, eye.transform)
+    shade_time, _ = best_time(lambda : eye.shade_hits(scene, batch, *hits, origin), repeat)
+    result = {'bodies' : len(scene.bodies),
+              'bvh_build' : build,
+              'camera_rays' : rays_time,
+              'intersection' : cast_time,
+              'shading' : shade_time,
+              'intersection_tests' : tests[0],
+              'tests_per_sec' : tests[0]/cast_time,
+              'render' : {}}
+    for width, height in resolutions:
+        render_time, _ = best_time(lambda : eye.render(scene, width, height), repeat)
+        peak = peak_memory(lambda : eye.render(scene, width, height))
+        result['render'][f'{width}x{height}'] = {'time' : render_time,
+                                                 'rays_per_sec' : width*height/render_time,
+                                                 'peak_memory' : peak}
+    return result
+
+# Прогон набора сцен, результат - словарь, пригодный для записи в JSON
+def run_suite(suite = 'quick', resolutions = ((160, 120), (320, 240)), repeat = 3, log = None):
+    results = {}
+    for name, make, n in SUITES[suite]:
+        key = f'{name}-{n}'
+        results[key] = bench_scene(make(n), resolutions, repeat)
+        if log:
+            log(key, results[key])
+    return {'meta' : {'suite' : suite,
+                      'python' : platform.python_version(),
+                      'numpy' : np.__version__,
+                      'machine' : platform.machine()},
+            'results' : results}
+
+# Сравнение с сохранённым базовым прогоном: список замедлений больше чем на threshold
+# Сравниваются скорости лучей полной отрисовки и проверок пересечений
+def compare(current, baseline, threshold = 0.1):
+    regressions = []
+    for key, result in current['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            continue
+        pairs = [('tests_per_sec', result['tests_per_sec'], base['tests_per_sec'])]
+        for res, r in result['render'].items():
+            if res in base['render']:
+                pairs.append((f'{res} rays_per_sec', r['rays_per_sec'], base['render'][res]['rays_per_sec']))
+        for metric, now, then in pairs:
+            if now < then*(1.0-threshold):
+                regressions.append({'scene' : key, 'metric' : metric, 'baseline' : then, 'current' : now,
+                                    'change' : now/then-1.0})
+    return regressions
+
+# Сравнение иерархии объёмов с полным перебором тел на первичных лучах камеры
+def compare_bvh(scene, width, height):
+    batch = scene.camera.GridIterator(scene.camera, width, height).ray_batch()
+    scene.invalidate()
+    t0 = time.perf_counter()
+    scene.bvh
+    t1 = time.perf_counter()
+    bvh_t, bvh_ids, _ = scene.cast_batch(batch)
+    t2 = time.perf_counter()
+    all_t, all_ids, _ = scene.cast_batch(batch, accelerated = False)
+    t3 = time.perf_counter()
+    return {'bodies' : len(scene.bodies),
+            'rays' : len(batch),
+            'build' : t1-t0,
+            'bvh' : t2-t1,
+            'brute_force' : t3-t2,
+            'same_hits' : bool(np.array_equal(bvh_ids, all_ids) and np.array_equal(bvh_t, all_t))}
+
+
+# Сравнение отрисовки в float32 с float64: время, ускорение, пиковая память
+# и отличие пикселей - наибольшее и доля отличающихся каналов
+def compare_precision(scene, width, height, repeat = 3):
+    result = {'bodies' : len(scene.bodies)}
+    images = {}
+    for dtype in (np.float64, np.float32):
+        name = np.dtype(dtype).name
+        render = lambda : scene.camera.render(scene, width, height, dtype = dtype)
+        render_time, images[name] = best_time(render, repeat)
+        result[name] = {'time' : render_time, 'peak_memory' : peak_memory(render)}
+    diff = np.abs(images['float64'].astype(int)-images['float32'])
+    result['speedup'] = result['float64']['time']/result['float32']['time']
+    result['max_diff'] = int(diff.max())
+    result['diff_fraction'] = float(np.mean(diff > 0))
+    return result
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Замеры производительности рендерера')
+    parser.add_argument('--suite', choices = SUITES, default = 'quick')
+    parser.add_argument('--resolutions', nargs = '+', default = ['160x120', '320x240'])
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--out', help = 'файл для записи результатов в JSON')
+    parser.add_argument('--baseline', help = 'JSON базового прогона для сравнения')
+    parser.add_argument('--threshold', type = float, default = 0.1, help = 'допустимая доля замедления')
+    parser.add_argument('--bvh', type = int, nargs = '+', help = 'только сравнить BVH с перебором для сцен из N сфер')
+    parser.add_argument('--precision', action = 'store_true', help = 'только сравнить float32 с float64 на сценах набора')
+    args = parser.parse_args()
+    if args.bvh:
+        for n in args.bvh:
+            print(compare_bvh(random_spheres(n), 160, 120))
+        sys.exit(0)
+    resolutions = [tuple(int(v) for v in r.split('x')) for r in args.resolutions]
+    if args.precision:
+        for name, make, n in SUITES[args.suite]:
+            print(f'{name}-{n}', json.dumps(compare_precision(make(n), *resolutions[-1], args.repeat)))
+        sys.exit(0)
+    current = run_suite(args.suite, resolutions, args.repeat, log = lambda key, r : print(key, json.dumps(r)))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent = 2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(current, json.load(f), args.threshold)
+        for r in regressions:
+            print('REGRESSION', json.dumps(r))
+        sys.exit(1 if regressions else 0)
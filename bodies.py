@@ -1,31 +1,104 @@
+from bvh import BVH, box_spheres, inverse_dirs
 from materials import *
 from spatial import *
 from utils import *
 
+import weakref
 
 
+
+# Предрасчитанные данные преобразования: обратная матрица и матрицы для нормалей
+# Тела с одинаковыми матрицами преобразования делят один экземпляр, массивы в нём только для чтения
+class TransformData:
+    inverse : np.ndarray
+    normal_matrix : np.ndarray
+    point_normal : np.ndarray
+
+    def __init__(self, transform, inverse = None):
+        self.inverse = np.linalg.inv(transform) if inverse is None else np.array(inverse, float)
+        # Нормали переводятся транспонированной обратной матрицей
+        self.normal_matrix = self.inverse.T.copy()
+        # Перевод мировой точки сразу в ненормированную нормаль тела, у которого
+        # локальная нормаль совпадает с локальной точкой (единичная сфера)
+        self.point_normal = np.matmul(self.inverse, self.normal_matrix)
+        self.freeze()
+        self.variants = {}
+
+    def freeze(self):
+        for array in (self.inverse, self.normal_matrix, self.point_normal):
+            array.flags.writeable = False
+
+    # Данные в точности dtype: копии для пакетов float32 создаются один раз
+    def astype(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype == self.inverse.dtype:
+            return self
+        if dtype not in self.variants:
+            variant = object.__new__(TransformData)
+            variant.inverse = self.inverse.astype(dtype)
+            variant.normal_matrix = self.normal_matrix.astype(dtype)
+            variant.point_normal = self.point_normal.astype(dtype)
+            variant.freeze()
+            variant.variants = {}
+            self.variants[dtype] = variant
+        return self.variants[dtype]
+
+# Кэш данных преобразований по байтам матрицы, записи живут, пока на них ссылаются тела
+transform_cache = weakref.WeakValueDictionary()
+
+def transform_data(transform, inverse = None):
+    key = transform.tobytes()
+    data = transform_cache.get(key)
+    if data is None:
+        data = TransformData(transform, inverse)
+        transform_cache[key] = data
+    return data
+
 # Суперкласс объекта сцены
 class Body:
         transform : np.ndarray
         inv_transform : np.ndarray
-        colour : Colour
+        normal_matrix : np.ndarray
+        shared : TransformData
+        material : Material
+        casts_shadow = True
+        # Число смен преобразования у уже созданных тел, по нему сцены узнают о перемещениях без invalidate
+        moves = 0
 
         def __init__(self, transform = None, inv_transform = None):
-            self.transform = Mat4.Identity().data if transform == None else transform.data
-            if inv_transform == None:
-                self.set_inverse()
-            else:
-                self.inv_transform = inv_transform
+            self.material = Material()
+            if transform is None:
+                transform = Mat4.Identity()
+            if inv_transform is None:
+                inv_transform = transform.inverse
+            self.set_transform(transform.data.copy(), inv_transform)
 
         # Применение матричного преобразования к объекту - меняет его собственные матрицы
+        # Известная обратная матрица преобразования избавляет от обращения произведения
         def apply(self, transform : Mat4):
-            np.matmul(self.transform, transform.data, self.transform)
-            self.set_inverse()
+            inverse = None
+            if transform.inverse is not None:
+                inverse = np.matmul(transform.inverse, self.inv_transform)
+            self.set_transform(np.matmul(self.transform, transform.data), inverse)
+            self.on_transform()
             return self
 
+        # Установка матрицы преобразования и, если известна, обратной к ней
+        def set_transform(self, transform, inverse = None):
+            if 'transform' in self.__dict__:
+                Body.moves += 1
+            self.transform = transform
+            self.shared = transform_data(transform, inverse)
+            self.inv_transform = self.shared.inverse
+            self.normal_matrix = self.shared.normal_matrix
+
         # Определение обратного преобразования из локальной системы координат в глобальную
         def set_inverse(self):
-            self.inv_transform = np.linalg.inv(self.transform)
+            self.set_transform(self.transform)
+
+        # Обновление зависящих от преобразования данных, переопределяется субклассами
+        def on_transform(self):
+            pass
 
         def intersect(self, ray : Ray):
             return [Intersection(t, self) for t in self.find_intersections(ray)]
@@ -34,32 +107,189 @@ class Body:
         def find_intersections(self, ray : Ray):
             pass
 
+        # Поиск ближайших неотрицательных пересечений для пакета лучей
+        # Возвращает плотный массив t (N,), inf означает промах
+        # Базовая реализация перебирает лучи по одному, примитивы переопределяют её векторно
+        def intersect_batch(self, batch : RayBatch):
+            result = np.full(len(batch), np.inf, batch.dtype)
+            for i in range(len(batch)):
+                ts = [t for t in self.find_intersections(batch.ray(i)) if t >= 0.0]
+                if ts:
+                    result[i] = min(ts)
+            return result
+
+        # Ближайшие пересечения пакета вместе с номерами граней (-1 для тел без граней)
+        def hit_batch(self, batch : RayBatch):
+            return self.intersect_batch(batch), np.full(len(batch), -1)
+
+        # Нормали для массива точек (N,4), faces - номера граней из hit_batch
+        def normal_arrays_at(self, world_points, faces = None):
+            return np.array([self.normal_array_at(p) for p in world_points], world_points.dtype).reshape((-1, 4))
+
+        # Ограничивающий параллелепипед в локальной системе координат: массив (2,3) из минимума и максимума
+        # По умолчанию тело считается неограниченным
+        def local_bounds(self):
+            return np.array(((-np.inf,)*3, (np.inf,)*3))
+
+        # Ограничивающий параллелепипед в мировой системе координат по образам углов локального
+        def world_bounds(self):
+            lo, hi = self.local_bounds()
+            if not (np.all(np.isfinite(lo)) and np.all(np.isfinite(hi))):
+                return np.array(((-np.inf,)*3, (np.inf,)*3))
+            corners = np.array([(x, y, z, 1.0) for x in (lo[0], hi[0])
+                                               for y in (lo[1], hi[1])
+                                               for z in (lo[2], hi[2])])
+            world = np.matmul(corners, self.transform)[:,:3]
+            return np.array((world.min(axis = 0), world.max(axis = 0)))
+
+        # Описанная сфера в мировой системе координат: центр (3,) и радиус
+        # По умолчанию строится по параллелепипеду world_bounds
+        def bounding_sphere(self):
+            centres, radii = box_spheres(self.world_bounds()[None])
+            return centres[0], radii[0]
+
+        # Цвет объекта хранится в его материале
+        @property
+        def colour(self):
+            return self.material.colour
+
+        @colour.setter
+        def colour(self, colour : Colour):
+            self.material.colour = colour
+
+        # Материалы тела для таблицы материалов сцены, у однородных тел - один материал
+        def materials(self):
+            return [self.material]
+
+        # Номера материалов из materials() для граней faces из hit_batch
+        def material_indices(self, faces):
+            return np.zeros(len(faces), int)
+
+        # Цвет поверхности в точке грани face для попиксельной отрисовки
+        def colour_at(self, face = -1):
+            return self.colour
+
         # Задание цвета объекта
         def coloured(self, colour : Colour):
             self.colour = colour
             return self
 
+        # Задание отражающей способности объекта
+        def reflective(self, reflectivity : float):
+            self.material.reflectivity = reflectivity
+            return self
+
+        # Задание коэффициентов модели Фонга, не указанные остаются прежними
+        def shading(self, ambient = None, diffuse = None, specular = None, shininess = None):
+            for name, value in (('ambient', ambient), ('diffuse', diffuse), ('specular', specular), ('shininess', shininess)):
+                if value is not None:
+                    setattr(self.material, name, float(value))
+            return self
+
+        # Включение или отключение тени, отбрасываемой объектом
+        def casting_shadow(self, casts = True):
+            self.casts_shadow = casts
+            return self
+
+# Групповое применение преобразований к телам
+# transforms - одна матрица Mat4 для всех тел, список Mat4 или массив (B,4,4) по одной на тело
+# Матрицы всех тел и их обратные перемножаются одним пакетным умножением,
+# при неизвестных обратных матрицах обращение тоже выполняется пакетом
+def apply_all(bodies, transforms):
+    if not bodies:
+        return bodies
+    current = np.stack([b.transform for b in bodies])
+    inverses = None
+    if isinstance(transforms, Matrix):
+        data, inverses = transforms.data, transforms.inverse
+    elif isinstance(transforms, np.ndarray):
+        data = transforms
+    else:
+        data = np.stack([t.data for t in transforms])
+        if all(t.inverse is not None for t in transforms):
+            inverses = np.stack([t.inverse for t in transforms])
+    result = np.matmul(current, data)
+    if inverses is None:
+        result_inv = np.linalg.inv(result)
+    else:
+        result_inv = np.matmul(inverses, np.stack([b.inv_transform for b in bodies]))
+    for b, transform, inverse in zip(bodies, result, result_inv):
+        b.set_transform(transform, inverse)
+        b.on_transform()
+    return bodies
+
+
+
 # Класс многоугольников
+# Плоскость и рёбра задаются в локальной системе координат, поэтому считаются один раз при создании:
+# проверка вхождения точки сводится к знакам линейных функций рёбер в проекции на координатную плоскость
 class Polygon(Body):
     std : bool
     points : np.ndarray
     normal : np.ndarray
     D : float
+    # Оси проекции (u, v) и коэффициенты (E,3) функций рёбер a*Qu+b*Qv+c
+    axes : tuple
+    edges : np.ndarray
     
     def __init__(self, points, transform = None, inv_transform = None, std = False):
         super().__init__(transform, inv_transform)
         self.std = std
-        self.points = points
+        self.points = np.asarray(points, float)[:,:3]
         if std:
             self.normal = np.array((0.0, 1.0, 0.0))
             self.D = 0.0
         else:
             self.normal = self.get_normal()
             self.D = self.get_D()
+        self.edges = self.get_edges()
+        self.pack()
+
+    def on_transform(self):
+        self.pack()
+
+    # Предрасчёт мировой нормали после изменения преобразования
+    def pack(self):
+        normal = np.matmul(np.append(self.normal, 0.0), self.normal_matrix)
+        normal[3] = 0.0
+        self.plane_normal = normal/math.sqrt(np.sum(normal*normal))
 
-    # Абстрактный метод проверки вхождения точки в полигон, имплементируется субклассами
+    # Пары вершин (начало, конец) рёбер, по которым проверяется вхождение, переопределяется субклассами
+    def get_sides(self):
+        return [(k, (k+1) % len(self.points)) for k in range(len(self.points))]
+
+    # Коэффициенты функций рёбер в проекции вдоль преобладающей оси нормали
+    # Функция неотрицательна слева от ребра, если смотреть против нормали, как и знак
+    # смешанного произведения (side x (Q-vertex)) . normal для точек плоскости
+    def get_edges(self):
+        k = int(np.argmax(np.abs(self.normal)))
+        u, v = (k+1) % 3, (k+2) % 3
+        self.axes = (u, v)
+        sign = 1.0 if self.normal[k] > 0.0 else -1.0
+        edges = []
+        for i, j in self.get_sides():
+            V, W = self.points[i], self.points[j]
+            a = -(W[v]-V[v])*sign
+            b = (W[u]-V[u])*sign
+            edges.append((a, b, -(a*V[u]+b*V[v])))
+        return np.array(edges)
+
+    # Значения функций рёбер (N,E) в точках (N,3)
+    def edge_values(self, Q):
+        u, v = self.axes
+        edges = self.edges.astype(Q.dtype, copy = False)
+        return Q[:,u,None]*edges[:,0]+Q[:,v,None]*edges[:,1]+edges[:,2]
+
+    # Проверка вхождения точки в полигон через проверку массива из одной точки
     def includes(self, Q):
-        pass
+        return bool(self.includes_array(np.asarray(Q)[None,:3])[0])
+
+    # Проверка вхождения массива точек (N,3), возвращает булеву маску; по умолчанию полигон выпуклый
+    def includes_array(self, Q):
+        return np.all(self.edge_values(Q) >= 0.0, axis = 1)
+
+    def local_bounds(self):
+        return np.array((self.points.min(axis = 0), self.points.max(axis = 0)))
 
     # Вычисление инварианта плоскости
     def get_D(self):
@@ -68,30 +298,50 @@ class Polygon(Body):
 
     # Вычисление нормали
     def get_normal(self):
-        A, B, C = self.points[:,:3]
+        A, B, C = self.points[:3,:3]
         normal = np.cross(B-A, C-A)
         magnitude = math.sqrt(sum(normal*normal))
         return normal/magnitude
     
     def find_intersections(self, ray : Ray):
-        normal = self.get_normal_array()
         objspace_ray = np.matmul(ray.data, self.inv_transform)
         orig, dirc = objspace_ray[:,:3]
-        denom = np.dot(normal, dirc)
+        denom = np.dot(self.normal, dirc)
         if floeq(denom, 0.0):
             return []
-        t = (self.get_D()-np.dot(normal, orig))/denom
+        t = (self.D-np.dot(self.normal, orig))/denom
         Q = orig+t*dirc
         return [t] if self.includes(Q) else []
 
+    def intersect_batch(self, batch : RayBatch):
+        dtype = batch.dtype
+        inverse = self.shared.astype(dtype).inverse
+        orig = np.matmul(batch.origins, inverse)[:,:3]
+        dirc = np.matmul(batch.directions, inverse)[:,:3]
+        normal = self.normal.astype(dtype)
+        denom = np.matmul(dirc, normal)
+        result = np.full(len(batch), np.inf, dtype)
+        # Лучи, параллельные плоскости, её не пересекают
+        idx = np.nonzero(np.abs(denom) >= epsilon(dtype))[0]
+        t = (dtype.type(self.D)-np.matmul(orig[idx], normal))/denom[idx]
+        front = t >= 0.0
+        idx, t = idx[front], t[front]
+        inside = self.includes_array(orig[idx]+t[:,None]*dirc[idx])
+        result[idx[inside]] = t[inside]
+        return result
+
+    # Нормаль плоскости в мировой системе координат, одна для всех точек
+    def world_normal(self):
+        return self.plane_normal.copy()
+
+    def normal_array_at(self, world_point, face = -1):
+        return self.world_normal()
+
+    def normal_arrays_at(self, world_points, faces = None):
+        return np.tile(self.plane_normal.astype(world_points.dtype), (len(world_points), 1))
+
 class Triangle(Polygon):
-    def includes(self, Q):
-        A, B, C = self.points
-        tup = ((B-A, A), (A-C, C), (C-B, B))
-        for side, vertex in tup:
-            if np.dot(self.normal, np.cross(side, Q-vertex)) < 0.0:
-                return False
-        return True
+    pass
 
 # Класс четырехугольника/плоскости
 class Quad(Polygon):
@@ -125,100 +375,436 @@ class Quad(Polygon):
         return Quad(transform = Mat4.Scaler(x_scale, 1.0, y_scale)*Mat4.Rotor(0, -math.pi/2))
     
     def __init__(self, points = None, transform = None, std = True):
-        if points == None:
+        if points is None:
             super().__init__(Quad.points, transform, std = std)
         else:
             super().__init__(points, transform)
     
-    def includes(self, Q):
-        A, B, C, D = self.points
-        if np.dot(self.normal, np.cross(C-A, Q-A)) >= 0.0:
-            # Q в полуплоскости вершины D
-            tup = ((D-C, C), (A-D, D))
-        else:
-            # Q в полуплоскости вершины B
-            tup = ((B-A, A), (B-C, B))
-        for side, vertex in tup:
-            if np.dot(self.normal, np.cross(side, Q-vertex)) < 0.0:
-                return False
-        return True
+    # Рёбра AB, BC, CD, DA и диагональ AC, делящая четырёхугольник на два треугольника,
+    # так что невыпуклые четырёхугольники тоже проверяются верно
+    def get_sides(self):
+        return [(0, 1), (1, 2), (2, 3), (3, 0), (0, 2)]
+
+    def includes_array(self, Q):
+        e = self.edge_values(Q) >= 0.0
+        # Точка в полуплоскости вершины D или вершины B относительно диагонали
+        return np.where(e[:,4], e[:,2] & e[:,3], e[:,0] & e[:,1])
 
 
 
 class Sphere(Body):
     def __init__(self, radius = None, center = None, transform = None):
-        if radius == None and center == None:
+        if radius is None and center is None:
             super().__init__(transform)
         else:
-            t = Mat4.Identity() if radius == None else Mat4.Scaler(radius, radius, radius)
-            if not transform == None:
+            t = Mat4.Identity() if radius is None else Mat4.Scaler(radius, radius, radius)
+            if transform is not None:
                 t *= transform
-            if not center == None:
+            if center is not None:
                 t *= Mat4.Translator(*center[:3])
             super().__init__(t)
     
     def find_intersections(self, ray : Ray):
         object_ray = np.matmul(ray.data, self.inv_transform)
-        orig, dirc = np.vsplit(object_ray[:,:3], 2)
-        a = np.dot(dirc, dirc.T)
-        b = 2.0*np.dot(dirc, orig.T)
-        c = np.dot(orig, orig.T)-1.0
-        discriminant = b*b-4*a*c
-        if discriminant < 0:
+        orig, dirc = object_ray[:,:3]
+        # Корни считаются от ближайшей к центру точки луча: дискриминант через её расстояние
+        # до центра не теряет точность при далёком от сферы начале луча
+        a = np.sum(dirc*dirc)
+        tc = -np.sum(dirc*orig)/a
+        closest = orig+tc*dirc
+        h = (1.0-np.sum(closest*closest))/a
+        if h < 0:
             return []
-        elif discriminant == 0:
-            return [-b/(2.0*a)]
+        elif h == 0:
+            return [tc]
         else:
-            d = math.sqrt(discriminant)
-            return [(-b-d)/(2.0*a), (-b+d)/(2.0*a)]
-    
-    def normal_array_at(self, world_point):
-        object_normal = np.matmul(world_point.data, self.inv_transform)
-        world_normal = np.matmul(object_normal, self.transform.T).T
+            d = math.sqrt(h)
+            return [tc-d, tc+d]
+
+    # Векторизованный поиск пересечений для пакета лучей
+    def intersect_batch(self, batch : RayBatch):
+        inverse = self.shared.astype(batch.dtype).inverse
+        orig = np.matmul(batch.origins, inverse)[:,:3]
+        dirc = np.matmul(batch.directions, inverse)[:,:3]
+        a = np.sum(dirc*dirc, axis = 1)
+        tc = -np.sum(dirc*orig, axis = 1)/a
+        closest = orig+tc[:,None]*dirc
+        h = (1.0-np.sum(closest*closest, axis = 1))/a
+        result = np.full(len(batch), np.inf, batch.dtype)
+        hit = h >= 0
+        d = np.sqrt(h[hit])
+        tc = tc[hit]
+        near = tc-d
+        far = tc+d
+        # Ближайший корень, лежащий перед началом луча
+        result[hit] = np.where(near >= 0.0, near, np.where(far >= 0.0, far, np.inf))
+        return result
+
+    def local_bounds(self):
+        return np.array(((-1.0,)*3, (1.0,)*3))
+
+    # Образ единичной сферы лежит в шаре с центром в образе начала координат
+    # и радиусом, равным наибольшему растяжению матрицы преобразования
+    def bounding_sphere(self):
+        return self.transform[3,:3].copy(), np.linalg.norm(self.transform[:3,:3], 2)
+
+    # Локальная нормаль единичной сферы совпадает с локальной точкой, поэтому мировая точка
+    # переводится в нормаль одним умножением на совмещённую матрицу
+    def normal_array_at(self, world_point, face = -1):
+        world_normal = np.matmul(world_point, self.shared.point_normal)
         world_normal[3] = 0
         world_normal /= math.sqrt(np.sum(world_normal*world_normal))
         return world_normal
 
+    def normal_arrays_at(self, world_points, faces = None):
+        world_normals = np.matmul(world_points, self.shared.astype(world_points.dtype).point_normal)
+        world_normals[:,3] = 0
+        world_normals /= np.sqrt(np.sum(world_normals*world_normals, axis = 1))[:,None]
+        return world_normals
+
+
+# Векторизованный поиск пересечений лучей (n,3) со сферами с центрами (m,3) и радиусами (m,)
+# Те же формулы, что в Sphere.find_intersections, но в мировой системе координат
+# Возвращает массив t (n,m) ближайших неотрицательных корней, inf означает промах
+def sphere_hits(orig, dirc, centres, radii):
+    oc = orig[:,None]-centres[None]
+    a = np.sum(dirc*dirc, axis = 1)[:,None]
+    tc = -np.sum(dirc[:,None]*oc, axis = 2)/a
+    closest = oc+tc[:,:,None]*dirc[:,None]
+    h = (radii*radii-np.sum(closest*closest, axis = 2))/a
+    with np.errstate(invalid = 'ignore'):
+        d = np.sqrt(h)
+    near = tc-d
+    far = tc+d
+    return np.where(h >= 0, np.where(near >= 0.0, near, np.where(far >= 0.0, far, np.inf)), np.inf)
+
+
+
+# Поле одинаковых по материалу сфер, упакованных в массивы центров (M,3), радиусов (M,)
+# и номеров цветов палитры (M,): на экземпляр приходится лишь строка массивов, а не отдельное тело
+# Пересечения ищутся по собственной иерархии объёмов экземпляров, номер экземпляра служит номером грани,
+# так что поле смешивается в сцене с обычными телами; преобразование поля двигает центры и масштабирует
+# радиусы (неоднородное масштабирование сводится к среднему)
+class SphereField(Body):
+    centres : np.ndarray
+    radii : np.ndarray
+    colour_ids : np.ndarray
+    palette : np.ndarray
+    world_centres : np.ndarray
+    world_radii : np.ndarray
+    leaf_size = 32
+    # Ограничение на размер промежуточных массивов (лучи * экземпляры)
+    chunk = 1 << 18
+
+    # palette - список цветов Colour или массив (K,3), без неё все сферы окрашены цветом материала
+    def __init__(self, centres, radii, colour_ids = None, palette = None, transform = None):
+        super().__init__(transform)
+        self.centres = np.asarray(centres, float)[:,:3]
+        self.radii = np.broadcast_to(np.asarray(radii, float), (len(self.centres),)).copy()
+        self.colour_ids = np.zeros(len(self.centres), np.int32) if colour_ids is None else np.asarray(colour_ids, np.int32)
+        if palette is not None and len(palette) and isinstance(palette[0], Colour):
+            palette = [c.data[:3] for c in palette]
+        self.palette = None if palette is None else np.asarray(palette, float).reshape((-1, 3))
+        self.pack()
+
+    def __len__(self):
+        return len(self.centres)
+
+    def on_transform(self):
+        self.pack()
+
+    # Перевод центров и радиусов в мировую систему и построение иерархии экземпляров
+    def pack(self):
+        self.world_centres = np.matmul(self.centres, self.transform[:3,:3])+self.transform[3,:3]
+        scale = abs(np.linalg.det(self.transform[:3,:3]))**(1.0/3.0)
+        self.world_radii = self.radii*scale
+        r = self.world_radii[:,None]
+        self.bvh = BVH(np.stack((self.world_centres-r, self.world_centres+r), axis = 1), self.leaf_size)
+        self.field_cache = {}
+
+    # Центры и радиусы в точности dtype, копии хранятся до следующей упаковки
+    def instances_as(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in self.field_cache:
+            self.field_cache[dtype] = (self.world_centres.astype(dtype), self.world_radii.astype(dtype))
+        return self.field_cache[dtype]
+
+    def world_bounds(self):
+        if len(self) == 0:
+            return np.zeros((2, 3))
+        return self.bvh.root_bounds()
+
+    # Ближайшие пересечения лучей с экземплярами instances, лучи обрабатываются частями по chunk
+    def hit_instances(self, orig, dirc, instances):
+        t = np.empty(len(orig), orig.dtype)
+        instance = np.empty(len(orig), int)
+        step = max(1, self.chunk//len(instances))
+        centres, radii = (a[instances] for a in self.instances_as(orig.dtype))
+        for i in range(0, len(orig), step):
+            ts = sphere_hits(orig[i:i+step], dirc[i:i+step], centres, radii)
+            k = np.argmin(ts, axis = 1)
+            t[i:i+step] = ts[np.arange(len(k)), k]
+            instance[i:i+step] = instances[k]
+        return t, instance
+
+    def hit_batch(self, batch : RayBatch):
+        orig = batch.origins[:,:3]
+        dirc = batch.directions[:,:3]
+        def test(instances, idx):
+            t, instance = self.hit_instances(orig[idx], dirc[idx], instances)
+            return t, instance, instance
+        t, instance, _ = self.bvh.nearest_batch(batch, test)
+        return t, instance
+
+    def intersect_batch(self, batch : RayBatch):
+        return self.hit_batch(batch)[0]
+
+    def intersect(self, ray : Ray):
+        t, instance = self.hit_batch(RayBatch.make(ray.origin, ray.direction[None]))
+        return [Intersection(t[0], self, instance[0])] if t[0] < np.inf else []
+
+    def find_intersections(self, ray : Ray):
+        return [i.t for i in self.intersect(ray)]
+
+    def normal_array_at(self, world_point, face = -1):
+        return self.normal_arrays_at(world_point[None], np.array((face,)))[0]
+
+    def normal_arrays_at(self, world_points, faces = None):
+        centres, radii = self.instances_as(world_points.dtype)
+        normals = np.zeros_like(world_points)
+        normals[:,:3] = (world_points[:,:3]-centres[faces])/radii[faces,None]
+        return normals
+
+    # Цвета палитры - материалы с общими для поля коэффициентами
+    def materials(self):
+        if self.palette is None:
+            return [self.material]
+        return [self.material.recoloured(Colour.RGB(*c)) for c in self.palette]
+
+    def material_indices(self, faces):
+        if self.palette is None:
+            return super().material_indices(faces)
+        return self.colour_ids[faces]
+
+    def colour_at(self, face = -1):
+        if self.palette is None:
+            return self.colour
+        return Colour.RGB(*self.palette[self.colour_ids[face]])
+
             
 
 
 
-# Класс многогранника
+# Векторизованный тест Мёллера-Трумбора: лучи (n,3) против треугольников (m,3) с рёбрами e1, e2
+# Возвращает массив t (n,m), inf означает промах
+def moller_trumbore(orig, dirc, v0, e1, e2):
+    p = np.cross(dirc[:,None], e2[None])
+    det = np.sum(e1*p, axis = 2)
+    valid = np.abs(det) >= epsilon(det.dtype)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        inv_det = 1.0/det
+        s = orig[:,None]-v0[None]
+        u = np.sum(s*p, axis = 2)*inv_det
+        q = np.cross(s, e1[None])
+        v = np.sum(dirc[:,None]*q, axis = 2)*inv_det
+        t = np.sum(e2[None]*q, axis = 2)*inv_det
+        valid &= (u >= 0.0) & (v >= 0.0) & (u+v <= 1.0) & (t >= 0.0)
+    return np.where(valid, t, np.inf)
+
+
+
+# Класс многогранника - упакованная треугольная сетка
+# Вершины хранятся в локальной системе, а для пересечений заранее переводятся в мировую
+# вместе с рёбрами и нормалями граней; поиск пересечений идёт по собственной иерархии объёмов граней
 class Polyhedron(Body):
     points : np.ndarray
     indices : np.ndarray
+    world_points : np.ndarray
+    v0 : np.ndarray
+    e1 : np.ndarray
+    e2 : np.ndarray
+    normals : np.ndarray
+    leaf_size = 8
+    # Ограничение на размер промежуточных массивов (лучи * грани) теста Мёллера-Трумбора
+    chunk = 1 << 18
 
-    def __init__(self, points, indices):
-        super().__init__()
+    def __init__(self, points, indices, transform = None):
+        super().__init__(transform)
+        points = np.asarray(points, float)
+        if points.shape[1] == 3:
+            points = np.hstack((points, np.ones((len(points), 1))))
         self.points = points
-        self.indices = indices
-    
-    def apply(self, *transforms):
-        for t in transforms:
-            self.transforms.insert(0, t)
-            self.points = np.matmul(self.points, t)
-        return self
-
-class Box(Polyhedron):
-    def __init__(self, scale = None, center = None):
-        points = np.array((( 0.5,  0.5,  0.5,  1.0),
-                           ( 0.5,  0.5, -0.5,  1.0),
-                           (-0.5,  0.5, -0.5,  1.0),
-                           (-0.5,  0.5,  0.5,  1.0),
-                           ( 0.5, -0.5,  0.5,  1.0),
-                           ( 0.5, -0.5, -0.5,  1.0),
-                           (-0.5, -0.5, -0.5,  1.0),
-                           (-0.5, -0.5,  0.5,  1.0)))
-        indices = np.array(((0, 4, 1),
-                            (5, 1, 4),
-                            (3, 2, 7),
-                            (6, 7, 2),
-                            (0, 1, 3),
-                            (2, 3, 1),
-                            (4, 7, 5),
-                            (6, 5, 7),
-                            (0, 3, 4),
-                            (7, 4, 3),
-                            (1, 5, 2),
-                            (6, 2, 5)))
-        super().__init__(points, indices)
+        self.indices = np.asarray(indices, int).reshape((-1, 3))
+        self.pack()
+
+    # Упаковка одиночных треугольников в одну сетку
+    def of_triangles(triangles):
+        points = []
+        for tri in triangles:
+            local = np.hstack((tri.points, np.ones((3, 1))))
+            points.append(np.matmul(local, tri.transform))
+        mesh = Polyhedron(np.vstack(points), np.arange(3*len(triangles)).reshape((-1, 3)))
+        if triangles:
+            mesh.material = triangles[0].material
+        return mesh
+
+    def on_transform(self):
+        self.pack()
+
+    # Перевод вершин в мировую систему, предрасчёт рёбер, нормалей и иерархии граней
+    def pack(self):
+        self.world_points = np.matmul(self.points, self.transform)[:,:3]
+        tris = self.world_points[self.indices]
+        self.v0 = tris[:,0].copy()
+        self.e1 = tris[:,1]-tris[:,0]
+        self.e2 = tris[:,2]-tris[:,0]
+        normals = np.cross(self.e1, self.e2)
+        # Вырожденные грани получают нулевую нормаль
+        magnitudes = np.sqrt(np.sum(normals*normals, axis = 1))
+        normals /= np.where(magnitudes > 0.0, magnitudes, 1.0)[:,None]
+        self.normals = np.hstack((normals, np.zeros((len(normals), 1))))
+        self.face_cache = {}
+        self.bvh = BVH(np.stack((tris.min(axis = 1), tris.max(axis = 1)), axis = 1), self.leaf_size)
+
+    def local_bounds(self):
+        return np.array((self.points[:,:3].min(axis = 0), self.points[:,:3].max(axis = 0)))
+
+    def world_bounds(self):
+        return np.array((self.world_points.min(axis = 0), self.world_points.max(axis = 0)))
+
+    # Вершины и рёбра граней в точности dtype, копии хранятся до следующей упаковки
+    def faces_as(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in self.face_cache:
+            self.face_cache[dtype] = tuple(a.astype(dtype) for a in (self.v0, self.e1, self.e2))
+        return self.face_cache[dtype]
+
+    # Ближайшие пересечения лучей с гранями faces, лучи обрабатываются частями по chunk
+    def hit_faces(self, orig, dirc, faces):
+        t = np.empty(len(orig), orig.dtype)
+        face = np.empty(len(orig), int)
+        step = max(1, self.chunk//len(faces))
+        v0, e1, e2 = (a[faces] for a in self.faces_as(orig.dtype))
+        for i in range(0, len(orig), step):
+            ts = moller_trumbore(orig[i:i+step], dirc[i:i+step], v0, e1, e2)
+            k = np.argmin(ts, axis = 1)
+            t[i:i+step] = ts[np.arange(len(k)), k]
+            face[i:i+step] = faces[k]
+        return t, face
+
+    def hit_batch(self, batch : RayBatch):
+        orig = batch.origins[:,:3]
+        dirc = batch.directions[:,:3]
+        def test(faces, idx):
+            t, face = self.hit_faces(orig[idx], dirc[idx], faces)
+            return t, face, face
+        t, face, _ = self.bvh.nearest_batch(batch, test)
+        return t, face
+
+    def intersect_batch(self, batch : RayBatch):
+        return self.hit_batch(batch)[0]
+
+    def intersect(self, ray : Ray):
+        t, face = self.hit_batch(RayBatch.make(ray.origin, ray.direction[None]))
+        return [Intersection(t[0], self, face[0])] if t[0] < np.inf else []
+
+    def find_intersections(self, ray : Ray):
+        return [i.t for i in self.intersect(ray)]
+
+    def normal_array_at(self, world_point, face = -1):
+        return self.normals[face].copy()
+
+    def normal_arrays_at(self, world_points, faces = None):
+        return self.normals[faces].astype(world_points.dtype, copy = False)
+
+# Параллелепипед [-0.5, 0.5]^3 в локальной системе координат
+# Пересечение ищется методом плит одной проверкой на луч; номер грани 2*ось+сторона
+# (сторона 0 - грань с положительной нормалью) определяет нормаль в точке попадания
+class Box(Body):
+    local_normals = np.array((( 1.0,  0.0,  0.0,  0.0),
+                              (-1.0,  0.0,  0.0,  0.0),
+                              ( 0.0,  1.0,  0.0,  0.0),
+                              ( 0.0, -1.0,  0.0,  0.0),
+                              ( 0.0,  0.0,  1.0,  0.0),
+                              ( 0.0,  0.0, -1.0,  0.0)))
+
+    def __init__(self, scale = None, center = None, transform = None):
+        t = Mat4.Identity()
+        if scale is not None:
+            t *= Mat4.Scaler(*np.broadcast_to(scale, 3))
+        if transform is not None:
+            t *= transform
+        if center is not None:
+            t *= Mat4.Translator(*center[:3])
+        super().__init__(t)
+        self.pack()
+
+    def on_transform(self):
+        self.pack()
+
+    # Предрасчёт мировых нормалей граней после изменения преобразования
+    def pack(self):
+        normals = np.matmul(self.local_normals, self.normal_matrix)
+        normals[:,3] = 0.0
+        self.normals = normals/np.sqrt(np.sum(normals*normals, axis = 1))[:,None]
+
+    def local_bounds(self):
+        return np.array(((-0.5,)*3, (0.5,)*3))
+
+    # Входные и выходные параметры лучей пакета с гранями входа и выхода
+    def slabs(self, batch : RayBatch):
+        inverse = self.shared.astype(batch.dtype).inverse
+        orig = np.matmul(batch.origins, inverse)[:,:3]
+        dirc = np.matmul(batch.directions, inverse)[:,:3]
+        inv_dirs = inverse_dirs(dirc)
+        half = batch.dtype.type(0.5)
+        with np.errstate(invalid = 'ignore'):
+            t1 = (-half-orig)*inv_dirs
+            t2 = (half-orig)*inv_dirs
+        # fmin/fmax пропускают NaN при нулевой компоненте направления на границе плиты
+        near = np.fmin(t1, t2)
+        far = np.fmax(t1, t2)
+        near_axis = np.argmax(np.nan_to_num(near, nan = -np.inf), axis = 1)
+        far_axis = np.argmin(np.nan_to_num(far, nan = np.inf), axis = 1)
+        rows = np.arange(len(batch))
+        tnear = near[rows, near_axis]
+        tfar = far[rows, far_axis]
+        # Луч входит через грань, противоположную направлению, и выходит через сонаправленную
+        near_face = 2*near_axis+(dirc[rows, near_axis] > 0.0)
+        far_face = 2*far_axis+(dirc[rows, far_axis] < 0.0)
+        return tnear, tfar, near_face, far_face
+
+    def hit_batch(self, batch : RayBatch):
+        tnear, tfar, near_face, far_face = self.slabs(batch)
+        t = np.full(len(batch), np.inf, batch.dtype)
+        face = np.full(len(batch), -1)
+        hit = (tnear <= tfar) & (tfar >= 0.0)
+        # Для начала луча внутри параллелепипеда берётся выход
+        inside = hit & (tnear < 0.0)
+        front = hit & ~inside
+        t[front], face[front] = tnear[front], near_face[front]
+        t[inside], face[inside] = tfar[inside], far_face[inside]
+        return t, face
+
+    def intersect_batch(self, batch : RayBatch):
+        return self.hit_batch(batch)[0]
+
+    def intersect(self, ray : Ray):
+        tnear, tfar, near_face, far_face = self.slabs(RayBatch.make(ray.origin, ray.direction[None]))
+        if tnear[0] > tfar[0]:
+            return []
+        return [Intersection(tnear[0], self, near_face[0]), Intersection(tfar[0], self, far_face[0])]
+
+    def find_intersections(self, ray : Ray):
+        return [i.t for i in self.intersect(ray)]
+
+    # Без номера грани нормаль берётся у грани, к плоскости которой точка ближе всего
+    def normal_array_at(self, world_point, face = -1):
+        if face < 0:
+            local = np.matmul(world_point, self.inv_transform)[:3]
+            axis = int(np.argmax(np.abs(local)))
+            face = 2*axis+int(local[axis] < 0.0)
+        return self.normals[face].copy()
+
+    def normal_arrays_at(self, world_points, faces = None):
+        return self.normals[faces].astype(world_points.dtype, copy = False)
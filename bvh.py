@@ -0,0 +1,253 @@
+from spatial import *
+from utils import *
+
+
+
+# Пересечение лучей с параллелепипедами методом плит
+# Возвращает массивы входных и выходных параметров t
+def slab_arrays(origins, inv_dirs, lo, hi):
+    with np.errstate(invalid = 'ignore'):
+        t1 = (lo-origins)*inv_dirs
+        t2 = (hi-origins)*inv_dirs
+    # fmin/fmax пропускают NaN, возникающие при нулевой компоненте направления на границе плиты
+    tnear = np.fmax.reduce(np.fmin(t1, t2), axis = -1)
+    tfar = np.fmin.reduce(np.fmax(t1, t2), axis = -1)
+    return tnear, tfar
+
+# Параллелепипеды (M,2,3) с небольшим запасом, чтобы пересечения на границе тела не отсекались погрешностью
+def padded(bounds):
+    pad = EPSILON*(1.0+np.abs(bounds))
+    return np.stack((bounds[:,0]-pad[:,0], bounds[:,1]+pad[:,1]), axis = 1)
+
+# Описанные сферы параллелепипедов (M,2,3): центры (M,3) и радиусы (M,)
+# Неограниченным параллелепипедам соответствуют сферы бесконечного радиуса с центром в начале координат
+def box_spheres(bounds):
+    finite = np.all(np.isfinite(bounds), axis = (1, 2))
+    with np.errstate(invalid = 'ignore'):
+        centres = np.where(finite[:,None], (bounds[:,0]+bounds[:,1])/2.0, 0.0)
+        radii = np.where(finite, np.sqrt(np.sum((bounds[:,1]-bounds[:,0])**2, axis = 1))/2.0, np.inf)
+    return centres, radii
+
+# Обратные направления лучей, нулевые компоненты дают бесконечности
+def inverse_dirs(directions):
+    with np.errstate(divide = 'ignore'):
+        return 1.0/directions[...,:3]
+
+
+
+# Иерархия ограничивающих объёмов над набором примитивов с параллелепипедами bounds (M,2,3)
+# Узлы хранятся плоскими массивами, листья ссылаются на отрезки массива order
+class BVH:
+    leaf_size = 2
+    lo : np.ndarray
+    hi : np.ndarray
+    left : np.ndarray
+    right : np.ndarray
+    axis : np.ndarray
+    start : np.ndarray
+    count : np.ndarray
+    order : np.ndarray
+
+    def __init__(self, bounds, leaf_size = None):
+        if leaf_size is not None:
+            self.leaf_size = leaf_size
+        bounds = np.asarray(bounds, float).reshape((-1, 2, 3))
+        self.bounds = padded(bounds)
+        with np.errstate(invalid = 'ignore'):
+            self.centroids = np.nan_to_num(0.5*(bounds[:,0]+bounds[:,1]), posinf = 0.0, neginf = 0.0)
+        self.nodes = []
+        self.order = np.arange(len(bounds))
+        if len(bounds):
+            self.build(0, len(bounds))
+        self.pack()
+
+    def __len__(self):
+        return len(self.order)
+
+    # Рекурсивное построение узла над отрезком order[start:end], возвращает индекс узла
+    def build(self, start, end):
+        prims = self.order[start:end]
+        box = self.bounds[prims]
+        node = [box[:,0].min(axis = 0), box[:,1].max(axis = 0), -1, -1, 0, start, end-start]
+        index = len(self.nodes)
+        self.nodes.append(node)
+        if end-start <= self.leaf_size:
+            return index
+        # Разбиение по медиане центров вдоль самой протяжённой оси
+        centroids = self.centroids[prims]
+        axis = int(np.argmax(centroids.max(axis = 0)-centroids.min(axis = 0)))
+        mid = (end-start)//2
+        self.order[start:end] = prims[np.argpartition(centroids[:,axis], mid)]
+        node[2] = self.build(start, start+mid)
+        node[3] = self.build(start+mid, end)
+        node[4] = axis
+        return index
+
+    # Перевод списка узлов в плоские массивы
+    def pack(self):
+        nodes = self.nodes
+        self.lo = np.array([n[0] for n in nodes]).reshape((-1, 3))
+        self.hi = np.array([n[1] for n in nodes]).reshape((-1, 3))
+        self.left, self.right, self.axis, self.start, self.count = (
+            np.array([n[i] for n in nodes], int) for i in range(2, 7))
+        del self.nodes
+        self.bounds_cache = {}
+        self.levels_cache = None
+
+    # Границы узлов (lo, hi) в точности dtype; при понижении точности округляются наружу,
+    # чтобы узлы не теряли попадания на своих гранях
+    def bounds_as(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype == self.lo.dtype:
+            return self.lo, self.hi
+        if dtype not in self.bounds_cache:
+            self.bounds_cache[dtype] = (np.nextafter(self.lo.astype(dtype), dtype.type(-np.inf)),
+                                        np.nextafter(self.hi.astype(dtype), dtype.type(np.inf)))
+        return self.bounds_cache[dtype]
+
+    # Пересчёт границ узлов после изменения параллелепипедов примитивов prims на bounds (m,2,3)
+    # без перестройки: разбиение остаётся прежним, поэтому при больших перемещениях
+    # узлы разрастаются и обход замедляется - тогда иерархию лучше построить заново
+    def refit(self, bounds, prims = None):
+        bounds = padded(np.asarray(bounds, float).reshape((-1, 2, 3)))
+        if prims is None:
+            self.bounds = bounds
+        else:
+            self.bounds[prims] = bounds
+        if len(self) == 0:
+            return
+        # Листья делят order на смежные отрезки, так что их границы - свёртки по отрезкам
+        leaves = np.nonzero(self.left < 0)[0]
+        leaves = leaves[np.argsort(self.start[leaves])]
+        box = self.bounds[self.order]
+        self.lo[leaves] = np.minimum.reduceat(box[:,0], self.start[leaves])
+        self.hi[leaves] = np.maximum.reduceat(box[:,1], self.start[leaves])
+        # Внутренние узлы пересчитываются по уровням снизу вверх, по уровню за раз
+        for level in reversed(self.levels()):
+            left, right = self.left[level], self.right[level]
+            self.lo[level] = np.minimum(self.lo[left], self.lo[right])
+            self.hi[level] = np.maximum(self.hi[left], self.hi[right])
+        self.bounds_cache = {}
+
+    # Внутренние узлы по уровням глубины от корня
+    def levels(self):
+        if self.levels_cache is None:
+            self.levels_cache = []
+            level = np.array((0,))
+            while True:
+                level = level[self.left[level] >= 0]
+                if len(level) == 0:
+                    break
+                self.levels_cache.append(level)
+                level = np.concatenate((self.left[level], self.right[level]))
+        return self.levels_cache
+
+    # Ограничивающий параллелепипед всей иерархии
+    def root_bounds(self):
+        return np.array((self.lo[0], self.hi[0]))
+
+    # Ближайшее пересечение одиночного луча, обход узлов от ближних к дальним
+    # test(prims) проверяет все примитивы листа и возвращает пару (t, prim) ближайшего из них
+    def nearest(self, origin, direction, test):
+        best_t, best_prim = np.inf, -1
+        if len(self) == 0:
+            return best_t, best_prim
+        origin = origin[:3]
+        inv_dir = inverse_dirs(direction)
+        tnear, tfar = slab_arrays(origin, inv_dir, self.lo[0], self.hi[0])
+        if tnear > tfar or tfar < 0.0:
+            return best_t, best_prim
+        stack = [(0, tnear)]
+        while stack:
+            node, tnear = stack.pop()
+            # Узел целиком дальше найденного пересечения
+            if tnear > best_t:
+                continue
+            left = self.left[node]
+            if left < 0:
+                t, prim = test(self.leaf(node))
+                if t < best_t or (t == best_t and t < np.inf and prim < best_prim):
+                    best_t, best_prim = t, prim
+                continue
+            children = (left, self.right[node])
+            tnears, tfars = slab_arrays(origin, inv_dir, self.lo[children,], self.hi[children,])
+            hits = [(tnears[i], children[i]) for i in (0, 1)
+                    if tnears[i] <= tfars[i] and tfars[i] >= 0.0 and tnears[i] <= best_t]
+            # Дальний ребёнок кладётся на стек первым и обходится последним
+            for tn, child in sorted(hits, reverse = True):
+                stack.append((child, tn))
+        return best_t, best_prim
+
+    # Ближайшие пересечения пакета лучей: обход узлов подпакетами активных лучей
+    # test(prims, idx) проверяет все примитивы листа для лучей с индексами idx и возвращает
+    # массивы t, выбранных примитивов и их внутренних номеров (например, граней сетки)
+    # Результат - массивы t (inf - промах), примитивов и внутренних номеров (-1 - промах)
+    def nearest_batch(self, batch : RayBatch, test):
+        best_t = np.full(len(batch), np.inf, batch.dtype)
+        best_prim = np.full(len(batch), -1)
+        best_sub = np.full(len(batch), -1)
+        if len(self) == 0 or len(batch) == 0:
+            return best_t, best_prim, best_sub
+        origins = batch.origins[:,:3]
+        inv_dirs = inverse_dirs(batch.directions)
+        lo, hi = self.bounds_as(batch.dtype)
+        stack = [(0, np.arange(len(batch)))]
+        while stack:
+            node, idx = stack.pop()
+            tnear, tfar = slab_arrays(origins[idx], inv_dirs[idx], lo[node], hi[node])
+            # Отсекаются лучи, промахнувшиеся мимо узла или уже нашедшие пересечение ближе него
+            idx = idx[(tnear <= tfar) & (tfar >= 0.0) & (tnear <= best_t[idx])]
+            if len(idx) == 0:
+                continue
+            left = self.left[node]
+            if left < 0:
+                t, prim, sub = test(self.leaf(node), idx)
+                cur_t, cur_prim = best_t[idx], best_prim[idx]
+                better = (t < cur_t) | ((t == cur_t) & (t < np.inf) & (prim < cur_prim))
+                best_t[idx[better]] = t[better]
+                best_prim[idx[better]] = prim[better]
+                best_sub[idx[better]] = sub[better]
+                continue
+            # Порядок обхода детей выбирается по преобладающему знаку направления вдоль оси разбиения
+            children = (left, self.right[node])
+            if np.sum(inv_dirs[idx, self.axis[node]] < 0.0) > len(idx)//2:
+                children = children[::-1]
+            stack.append((children[1], idx))
+            stack.append((children[0], idx))
+        return best_t, best_prim, best_sub
+
+    # Проверка пакета лучей на любое пересечение с параметром t из [0, tmax)
+    # test(prims, idx) возвращает маску перекрытых лучей idx и номера перекрывших их примитивов
+    # Перекрытый луч сразу выбывает из обхода, так что порядок узлов не важен
+    # Результат - маска перекрытых лучей и номера перекрывших примитивов (-1 - луч свободен)
+    def any_batch(self, batch : RayBatch, test, tmax = np.inf):
+        blocked = np.zeros(len(batch), bool)
+        blocker = np.full(len(batch), -1)
+        if len(self) == 0 or len(batch) == 0:
+            return blocked, blocker
+        origins = batch.origins[:,:3]
+        inv_dirs = inverse_dirs(batch.directions)
+        lo, hi = self.bounds_as(batch.dtype)
+        stack = [(0, np.arange(len(batch)))]
+        while stack:
+            node, idx = stack.pop()
+            idx = idx[~blocked[idx]]
+            tnear, tfar = slab_arrays(origins[idx], inv_dirs[idx], lo[node], hi[node])
+            idx = idx[(tnear <= tfar) & (tfar >= 0.0) & (tnear < tmax)]
+            if len(idx) == 0:
+                continue
+            left = self.left[node]
+            if left < 0:
+                hit, prim = test(self.leaf(node), idx)
+                blocked[idx[hit]] = True
+                blocker[idx[hit]] = prim[hit]
+                continue
+            stack.append((self.right[node], idx))
+            stack.append((left, idx))
+        return blocked, blocker
+
+    # Примитивы листа в порядке возрастания номеров
+    def leaf(self, node):
+        start = self.start[node]
+        return np.sort(self.order[start:start+self.count[node]])
+
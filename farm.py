@@ -0,0 +1,246 @@
+from optics import quantise
+from parallel import tiles
+from scenefile import content_hash, detached
+
+from collections import OrderedDict, deque
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import pickle
+import queue
+import socket
+import struct
+import threading
+import time
+
+
+
+# Сообщения между координатором и узлами - объекты pickle с длиной впереди
+# pickle исполняет код при разборе, поэтому ферма рассчитана только на доверенную сеть
+def send_message(sock, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('<Q', len(data))+data)
+
+def recv_exact(sock, size):
+    parts = []
+    while size:
+        part = sock.recv(min(size, 1 << 20))
+        if not part:
+            return None
+        parts.append(part)
+        size -= len(part)
+    return b''.join(parts)
+
+# Следующее сообщение или None, если соединение закрыто
+def recv_message(sock):
+    header = recv_exact(sock, 8)
+    if header is None:
+        return None
+    data = recv_exact(sock, struct.unpack('<Q', header)[0])
+    return None if data is None else pickle.loads(data)
+
+
+
+# Сцены узла по хэшу содержимого; хранятся между заданиями и переподключениями процесса,
+# так что та же сцена с новой камерой повторно не пересылается
+worker_scenes = OrderedDict()
+
+# Узел фермы: подключается к координатору по адресу (host, port) и отрисовывает выданные плитки
+# scenes - сколько последних сцен держать в памяти
+# Экранные прямоугольники тел для отсечения считаются один раз на кадр: сцену, камеру и разрешение
+def run_worker(host, port, scenes = 4):
+    frame, rects = None, None
+    with socket.create_connection((host, port)) as sock:
+        send_message(sock, ('hello', list(worker_scenes)))
+        while True:
+            message = recv_message(sock)
+            if message is None or message[0] == 'stop':
+                return
+            if message[0] == 'scene':
+                _, key, data = message
+                worker_scenes[key] = pickle.loads(data)
+                while len(worker_scenes) > scenes:
+                    worker_scenes.popitem(last = False)
+            elif message[0] == 'tile':
+                _, job, tile, rect, key, eye, width, height = message
+                scene = worker_scenes.get(key)
+                if scene is None:
+                    send_message(sock, ('missing', job, tile, key))
+                    continue
+                worker_scenes.move_to_end(key)
+                scene.camera = eye
+                if frame != (key, width, height, eye.fov, eye.transform.tobytes()):
+                    frame = (key, width, height, eye.fov, eye.transform.tobytes())
+                    rects = eye.screen_rects(scene, width, height) if eye.culling else None
+                x0, y0, x1, y1 = rect
+                pixels = quantise(eye.render_batch(scene, width, height, rect, None, rects)).reshape((y1-y0, x1-x0, 3))
+                send_message(sock, ('done', job, tile, pixels))
+
+# Запуск n локальных узлов в отдельных процессах, для проверки фермы на одной машине
+def start_workers(n, address):
+    processes = [multiprocessing.Process(target = run_worker, args = address, daemon = True) for _ in range(n)]
+    for p in processes:
+        p.start()
+    return processes
+
+
+
+# Подключённый к координатору узел: сокет, известные ему сцены и выданные плитки (задание, плитка)
+class FarmWorker:
+    def __init__(self, sock, scenes):
+        self.sock = sock
+        self.scenes = set(scenes)
+        self.assigned = {}
+        self.alive = True
+
+    def send(self, message):
+        try:
+            send_message(self.sock, message)
+            return True
+        except OSError:
+            self.alive = False
+            return False
+
+# Координатор фермы: принимает узлы на адресе address и раздаёт им плитки кадров
+# Сцена сериализуется не больше одного раза на отрисовку и отправляется только узлам, у которых её нет;
+# плитки умершего узла возвращаются в очередь, а плитку, которая считается дольше slow_after секунд,
+# получает ещё и свободный узел - в кадр идёт первый пришедший результат
+class Farm:
+    slow_after = 10.0
+    # Плиток в работе на узел: следующая плитка уже ждёт, пока считается текущая
+    window = 2
+
+    def __init__(self, host = '127.0.0.1', port = 0):
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        self.workers = []
+        self.events = queue.Queue()
+        self.jobs = itertools.count()
+        threading.Thread(target = self.accept, daemon = True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target = self.listen, args = (sock,), daemon = True).start()
+
+    # Чтение сообщений узла в общую очередь событий
+    def listen(self, sock):
+        try:
+            hello = recv_message(sock)
+        except OSError:
+            hello = None
+        if hello is None or hello[0] != 'hello':
+            sock.close()
+            return
+        worker = FarmWorker(sock, hello[1])
+        self.events.put(('join', worker, ()))
+        while True:
+            try:
+                message = recv_message(sock)
+            except OSError:
+                message = None
+            if message is None:
+                self.events.put(('dead', worker, ()))
+                return
+            self.events.put((message[0], worker, message[1:]))
+
+    def close(self):
+        for worker in self.workers:
+            worker.send(('stop',))
+            worker.sock.close()
+        self.workers = []
+        self.server.close()
+
+    # Отрисовка кадра узлами фермы, результат - изображение (height, width, 3) в байтах
+    # timeout - предельное время в секундах, после которого отрисовка прерывается с TimeoutError
+    def render(self, eye, scene, width, height, tile_size = 32, timeout = None):
+        job = next(self.jobs)
+        # Хэш хранится в сцене, а сериализуется она, только если сцены нет у какого-то узла
+        key = content_hash(scene)
+        data = None
+        rects = tiles(width, height, tile_size)
+        image = np.zeros((height, width, 3), np.uint8)
+        done = np.zeros(len(rects), bool)
+        pending = deque(range(len(rects)))
+        # Плитка -> время последней выдачи, пока она не готова
+        started = {}
+        deadline = None if timeout is None else time.perf_counter()+timeout
+        def dispatch():
+            nonlocal data
+            now = time.perf_counter()
+            for worker in self.workers:
+                while worker.alive and len(worker.assigned) < self.window:
+                    if pending:
+                        tile = pending.popleft()
+                    else:
+                        slow = [t for t, s in started.items() if now-s > self.slow_after and (job, t) not in worker.assigned]
+                        if not slow:
+                            break
+                        tile = min(slow, key = started.get)
+                    if key not in worker.scenes:
+                        if data is None:
+                            data = pickle.dumps(detached(scene), pickle.HIGHEST_PROTOCOL)
+                        if not worker.send(('scene', key, data)):
+                            pending.appendleft(tile)
+                            break
+                        worker.scenes.add(key)
+                    if not worker.send(('tile', job, tile, rects[tile], key, eye, width, height)):
+                        pending.appendleft(tile)
+                        break
+                    worker.assigned[(job, tile)] = now
+                    started[tile] = now
+        while not done.all():
+            dispatch()
+            if deadline is not None and time.perf_counter() > deadline:
+                raise TimeoutError(f'render farm finished {done.sum()} of {len(rects)} tiles')
+            try:
+                kind, worker, args = self.events.get(timeout = 0.05)
+            except queue.Empty:
+                continue
+            if kind == 'join':
+                self.workers.append(worker)
+            elif kind == 'dead':
+                worker.alive = False
+                if worker in self.workers:
+                    self.workers.remove(worker)
+                for j, tile in worker.assigned:
+                    if j == job and not done[tile] and not any((job, tile) in w.assigned for w in self.workers):
+                        started.pop(tile, None)
+                        pending.appendleft(tile)
+                worker.assigned = {}
+            elif kind == 'done':
+                j, tile, pixels = args
+                worker.assigned.pop((j, tile), None)
+                if j == job and not done[tile]:
+                    x0, y0, x1, y1 = rects[tile]
+                    image[y0:y1, x0:x1] = pixels
+                    done[tile] = True
+                    started.pop(tile, None)
+            elif kind == 'missing':
+                # Узел вытеснил сцену из своего кэша - она будет отправлена заново
+                j, tile, missing = args
+                worker.assigned.pop((j, tile), None)
+                worker.scenes.discard(missing)
+                if j == job and not done[tile]:
+                    pending.appendleft(tile)
+        return image
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Узел фермы отрисовки')
+    parser.add_argument('host', help = 'адрес координатора')
+    parser.add_argument('port', type = int)
+    parser.add_argument('--scenes', type = int, default = 4, help = 'сколько последних сцен хранить')
+    args = parser.parse_args()
+    run_worker(args.host, args.port, args.scenes)
@@ -0,0 +1,119 @@
+from materials import PHONG
+
+import numpy as np
+import os
+
+
+
+# Слой геометрического буфера - попадания одной волны лучей (первичных или отражённых на одной глубине)
+# pixel - номера пикселей, в которые идёт вклад, weight - доля вклада, t - параметр попадания,
+# position и normal - мировые точки и нормали (n,4), body - номера тел, colour - цвета поверхности (n,3),
+# origin - точки, из которых выпущены лучи (n,4), от них считается бликовая составляющая,
+# phong - коэффициенты модели Фонга материалов (n,4); без них берутся коэффициенты по умолчанию
+class Layer:
+    fields = ('pixel', 'weight', 't', 'position', 'normal', 'body', 'colour', 'origin', 'phong')
+    pixel : np.ndarray
+    weight : np.ndarray
+    t : np.ndarray
+    position : np.ndarray
+    normal : np.ndarray
+    body : np.ndarray
+    colour : np.ndarray
+    origin : np.ndarray
+    phong : np.ndarray
+
+    def __init__(self, pixel, weight, t, position, normal, body, colour, origin, phong = None):
+        self.pixel = pixel
+        self.weight = weight
+        self.t = t
+        self.position = position
+        self.normal = normal
+        self.body = body
+        self.colour = colour
+        self.origin = origin
+        if phong is None:
+            phong = np.tile(np.asarray(PHONG, colour.dtype), (len(pixel), 1))
+        self.phong = phong
+
+    def __len__(self):
+        return len(self.pixel)
+
+
+
+# Геометрический буфер кадра или прямоугольника rect для отложенного освещения
+# Хранит результат одного геометрического прохода Eye.capture, после которого relight
+# пересчитывает только освещение - без поиска пересечений первичных и отражённых лучей
+class GBuffer:
+    width : int
+    height : int
+    rect : tuple
+    shadows : bool
+    layers : list
+
+    def __init__(self, width, height, rect, layers, shadows = True, scene = None):
+        self.width = width
+        self.height = height
+        self.rect = tuple(int(v) for v in rect)
+        self.layers = layers
+        self.shadows = shadows
+        # Сцена нужна только для теневых лучей и на диск не сохраняется
+        self.scene = scene
+
+    def __repr__(self):
+        return f'GBuffer: {self.width}x{self.height} {self.rect}, layers {[len(l) for l in self.layers]}'
+
+    # Размер прямоугольника буфера в пикселях
+    def shape(self):
+        x0, y0, x1, y1 = self.rect
+        return y1-y0, x1-x0
+
+    # Плотный массив поля field слоя layer по пикселям прямоугольника, fill - значение для промахов
+    # Например pixels('t') - карта глубины, pixels('body', fill = -1) - номера тел
+    def pixels(self, field, layer = 0, fill = np.inf):
+        layer = self.layers[layer]
+        values = getattr(layer, field)
+        h, w = self.shape()
+        result = np.full((h*w,)+values.shape[1:], fill, np.result_type(values, np.asarray(fill)))
+        result[layer.pixel] = values
+        return result.reshape((h, w)+values.shape[1:])
+
+    # Освещение буфера источником light: изображение (h,w,3) в байтах
+    # Тени пересчитываются, если они были включены при захвате и известна сцена:
+    # переданная scene или та, по которой буфер был снят
+    def relight(self, light, scene = None, stats = None):
+        from optics import light_layers, quantise
+        scene = scene or self.scene
+        h, w = self.shape()
+        colours = light_layers(self.layers, light, h*w, scene if self.shadows else None, stats)
+        return quantise(colours).reshape((h, w, 3))
+
+    # Сохранение в файл .npz или в каталог файлов .npy, которые load открывает отображением в память
+    def save(self, path):
+        arrays = {'meta' : np.array((self.width, self.height)+self.rect+(int(self.shadows),))}
+        for k, layer in enumerate(self.layers):
+            for field in Layer.fields:
+                arrays[f'{k}_{field}'] = getattr(layer, field)
+        if str(path).endswith('.npz'):
+            np.savez(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok = True)
+            # Слои прошлого сохранения в том же каталоге удаляются
+            for name in os.listdir(path):
+                if name.endswith('.npy') and name.split('_')[0].isdigit():
+                    os.remove(os.path.join(path, name))
+            for name, array in arrays.items():
+                np.save(os.path.join(path, name+'.npy'), array)
+
+    # Загрузка буфера, сохранённого save; массивы каталога .npy отображаются в память без чтения
+    def load(path, scene = None):
+        if str(path).endswith('.npz'):
+            arrays = dict(np.load(path))
+        else:
+            arrays = {name[:-4] : np.load(os.path.join(path, name), mmap_mode = 'r')
+                      for name in os.listdir(path) if name.endswith('.npy')}
+        meta = [int(v) for v in arrays['meta']]
+        layers = []
+        while f'{len(layers)}_pixel' in arrays:
+            k = len(layers)
+            layers.append(Layer(*(arrays.get(f'{k}_{field}') for field in Layer.fields)))
+        return GBuffer(meta[0], meta[1], meta[2:6], layers, bool(meta[6]), scene)
@@ -0,0 +1,91 @@
+from materials import *
+from spatial import *
+from utils import *
+
+
+
+class LightSource:
+    position : Vec4
+
+    def apply(self, transform : Mat4):
+        np.matmul(self.position.data, transform.data, self.position.data)
+
+# Класс точечного источника света
+# radius - радиус действия: вклад плавно затухает до нуля на этом расстоянии, по умолчанию затухания нет
+class PointSource(LightSource):
+    intensity : Colour
+    radius : float
+
+    def __init__(self, position, intensity, radius = np.inf):
+        self.position = position
+        self.intensity = intensity
+        self.radius = radius
+
+# Множитель затухания на расстояниях distances от источника с радиусом действия radius
+def falloff(distances, radius):
+    return np.clip(1.0-(distances/radius)**2, 0.0, 1.0)**2
+
+
+
+# Набор точечных источников, упакованный в массивы положений (L,4), интенсивностей (L,3) и радиусов (L,)
+# Одиночный источник оборачивается без копирования, так что его изменения видны набору
+class Lights(LightSource):
+    sources : list
+    positions : np.ndarray
+    intensities : np.ndarray
+    radii : np.ndarray
+    # Источники, вклад которых в освещённость участка меньше threshold, при освещении участка пропускаются
+    threshold = 0.5/255
+    # Ограничение на размер промежуточных массивов (точки * источники) освещения
+    chunk = 1 << 16
+    # Число ячеек решётки по каждой оси, по ячейкам которой точки делятся для отсечения источников
+    grid = 4
+
+    def __init__(self, sources):
+        self.sources = list(sources)
+        if len(self.sources) == 1:
+            source = self.sources[0]
+            self.positions = source.position.data[None]
+            self.intensities = source.intensity.data[None,:3]
+            self.radii = np.array((source.radius,))
+        else:
+            self.positions = np.array([s.position.data for s in self.sources], float).reshape((-1, 4))
+            self.intensities = np.array([s.intensity.data[:3] for s in self.sources], float).reshape((-1, 3))
+            self.radii = np.array([s.radius for s in self.sources], float)
+
+    def __len__(self):
+        return len(self.sources)
+
+    # Набор из одного источника, списка источников или сам набор
+    def of(light):
+        if isinstance(light, Lights):
+            return light
+        return Lights([light] if isinstance(light, LightSource) else light)
+
+    def apply(self, transform : Mat4):
+        for s in self.sources:
+            s.apply(transform)
+        if len(self.sources) > 1:
+            np.matmul(self.positions, transform.data, self.positions)
+
+    # Номера источников, способных внести в точки параллелепипеда lo-hi вклад не меньше threshold
+    # Оценка сверху: фоновая, рассеянная и бликовая составляющие при ближайшей к источнику точке,
+    # gain - наибольшая их сумма на единицу интенсивности источника (по умолчанию для коэффициентов
+    # PHONG и цветов не ярче 1)
+    def visible(self, lo, hi, gain = 2.2):
+        nearest = np.clip(self.positions[:,:3], lo, hi)
+        distances = np.sqrt(np.sum((self.positions[:,:3]-nearest)**2, axis = 1))
+        bound = gain*self.intensities.max(axis = 1)*falloff(distances, self.radii)
+        return np.nonzero(bound >= self.threshold)[0]
+
+    # Разбиение точек (N,4) на группы по ячейкам решётки grid^3 над их параллелепипедом,
+    # источники отсекаются для каждой группы отдельно; одиночному источнику разбиение не нужно
+    def cells(self, points):
+        if len(self) == 1 or len(points) == 0:
+            return [np.arange(len(points))]
+        lo = points[:,:3].min(axis = 0)
+        size = points[:,:3].max(axis = 0)-lo
+        k = np.minimum((points[:,:3]-lo)/np.where(size > 0.0, size, 1.0)*self.grid, self.grid-1).astype(int)
+        keys = (k[:,0]*self.grid+k[:,1])*self.grid+k[:,2]
+        order = np.argsort(keys, kind = 'stable')
+        return np.split(order, np.nonzero(np.diff(keys[order]))[0]+1)
@@ -19,4 +19,92 @@ class Colour:
         self.data = array
     
     def blend(self, other):
-        self.data *= other.data
\ No newline at end of file
+        self.data *= other.data
+
+
+# Коэффициенты модели Фонга по умолчанию: фоновый, рассеянный, зеркальный и показатель блеска
+PHONG = (0.2, 1.0, 1.0, 10.0)
+
+# Материал тела: цвет поверхности, коэффициенты модели Фонга и доля отражённого света
+# Коэффициенты умножают фоновую, рассеянную и зеркальную составляющие, shininess - показатель блеска
+# Изменения атрибутов созданного материала считаются в Material.changes, по которому сцены
+# обновляют свои таблицы материалов; изменение массива цвета на месте (Colour.blend) не отслеживается
+class Material:
+    colour : Colour
+    reflectivity : float
+    ambient : float
+    diffuse : float
+    specular : float
+    shininess : float
+    changes = 0
+
+    def __init__(self, colour = None, reflectivity = 0.0, ambient = PHONG[0], diffuse = PHONG[1], specular = PHONG[2], shininess = PHONG[3]):
+        self.colour = colour
+        self.reflectivity = reflectivity
+        self.ambient = ambient
+        self.diffuse = diffuse
+        self.specular = specular
+        self.shininess = shininess
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            Material.changes += 1
+        super().__setattr__(name, value)
+
+    # Коэффициенты модели Фонга (4,): фоновый, рассеянный, зеркальный и блеск
+    def phong(self):
+        return np.array((self.ambient, self.diffuse, self.specular, self.shininess))
+
+    # Копия материала с другим цветом
+    def recoloured(self, colour : Colour):
+        return Material(colour, self.reflectivity, self.ambient, self.diffuse, self.specular, self.shininess)
+
+# Таблица материалов сцены: упакованные массивы цветов (M,3), коэффициентов Фонга (M,4) в порядке
+# Material.phong и отражающей способности (M,); у материалов без цвета цвет NaN
+# Материалы тела k занимают строки таблицы с offsets[k], так что цвета и коэффициенты пакета попаданий
+# собираются одной выборкой по номерам строк
+class MaterialTable:
+    colours : np.ndarray
+    phong : np.ndarray
+    reflectivity : np.ndarray
+    offsets : np.ndarray
+
+    def __init__(self, colours, phong, reflectivity, offsets = None):
+        self.colours = colours
+        self.phong = phong
+        self.reflectivity = reflectivity
+        self.offsets = np.arange(len(colours)) if offsets is None else offsets
+        # Тела с несколькими строками материалов
+        self.multi = np.nonzero(np.diff(np.append(self.offsets, len(colours))) > 1)[0]
+
+    def __len__(self):
+        return len(self.colours)
+
+    # Таблица по строке на материал
+    def of(materials):
+        materials = list(materials)
+        colours = np.array([np.full(3, np.nan) if m.colour is None else m.colour.data[:3] for m in materials], float)
+        return MaterialTable(colours.reshape((-1, 3)), np.array([m.phong() for m in materials]).reshape((-1, 4)),
+                             np.array([m.reflectivity for m in materials], float))
+
+    # Таблица материалов тел: строки каждого тела - его materials()
+    def of_bodies(bodies):
+        lists = [b.materials() for b in bodies]
+        counts = np.array([len(ms) for ms in lists], int)
+        table = MaterialTable.of(m for ms in lists for m in ms)
+        return MaterialTable(table.colours, table.phong, table.reflectivity, np.cumsum(counts)-counts)
+
+    # Объединение таблиц, строки тел следующей таблицы идут за строками предыдущей
+    def join(self, other):
+        return MaterialTable(np.concatenate((self.colours, other.colours)), np.concatenate((self.phong, other.phong)),
+                             np.concatenate((self.reflectivity, other.reflectivity)),
+                             np.concatenate((self.offsets, other.offsets+len(self))))
+
+    # Строки таблицы для попаданий в тела ids по граням faces: выборка по номерам тел,
+    # к которой тела с несколькими материалами добавляют номер материала грани
+    def rows(self, bodies, ids, faces):
+        rows = self.offsets[ids]
+        for i in np.intersect1d(self.multi, ids):
+            idx = np.nonzero(ids == i)[0]
+            rows[idx] += bodies[i].material_indices(faces[idx])
+        return rows
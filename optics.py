@@ -1,52 +1,124 @@
 from bodies import Body
+from gbuffer import GBuffer, Layer
+from lights import *
 from materials import *
+from parallel import render_parallel, render_parallel_tiles, tiles
 from scene import Scene
 from spatial import *
+from stats import RenderStats, timed
+from utils import *
 
-
-
-class LightSource:
-    position : Vec4
-
-    def apply(self, transform : Mat4):
-        np.matmul(self.position, transform, self.position)
-
-# Класс точечного источника света
-class PointSource(LightSource):
-    intensity : Colour
-
-    def __init__(self, position, intensity):
-        self.position = position
-        self.intensity = intensity
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import copy
+import time
 
 
 
 # Вычисление цвета пикселя от цвета поверности, ориентации векторов источника света, камеры и нормали
-def lighting(surf_colour : Colour, source : LightSource, point : np.ndarray, eye : np.ndarray, normal : np.ndarray):
+# Точка в тени (shadowed) освещается только фоновой составляющей
+# material задаёт коэффициенты модели Фонга, по умолчанию - PHONG
+def lighting(surf_colour : Colour, source : LightSource, point : np.ndarray, eye : np.ndarray, normal : np.ndarray, shadowed = False, material : Material = None):
+    ka, kd, ks, shininess = PHONG if material is None else material.phong()
     source_colour = source.intensity.data[:3]
+    source_vec = source.position.data - point
+    if source.radius < np.inf:
+        source_colour = source_colour * falloff(math.sqrt(np.sum(source_vec*source_vec)), source.radius)
     eff_colour = surf_colour.data[:3] * source_colour
-    ambient = 0.2 * eff_colour
-    source_vec = (source.position.data - point).T
+    ambient = ka * eff_colour
+    if shadowed:
+        return ambient
     source_vec /= math.sqrt(np.sum(source_vec*source_vec))
     eye_vec = eye - point
     eye_vec /= math.sqrt(np.sum(eye_vec*eye_vec))
     ldn = sum(source_vec*normal)
     if ldn < 0.0:
         return ambient
-    diffuse = eff_colour * ldn
+    diffuse = kd * eff_colour * ldn
     refl_vec = reflect_array(-source_vec, normal)
     rde = np.sum((refl_vec*eye_vec)[:3])
     if rde <= 0.0:
         return ambient + diffuse
-    specular = source_colour * math.pow(rde, 10.0)
+    specular = ks * source_colour * math.pow(rde, shininess)
     return ambient + diffuse + specular
 
+# Векторизованный вариант lighting для массивов точек и нормалей (N,4)
+# Цвета поверхности - массив (N,3) или один цвет (3,) на все точки, shadowed - маска точек в тени
+# coefficients - коэффициенты модели Фонга (N,4) или (4,) в порядке PHONG, по умолчанию PHONG
+def lighting_array(surf_colours : np.ndarray, source : LightSource, points : np.ndarray, eye : np.ndarray, normals : np.ndarray, shadowed = None, coefficients = None):
+    return lighting_lights(surf_colours, Lights.of(source), points, eye, normals,
+                           None if shadowed is None else shadowed[:,None], coefficients = coefficients)
+
+# Освещение точек набором источников lights: вклады источников с номерами idx (по умолчанию всех)
+# считаются массивами (N,K) и складываются одной редукцией; shadowed - маска (N,K) пар точка-источник в тени
+# Точки обрабатываются частями, чтобы промежуточные массивы не превышали Lights.chunk пар
+def lighting_lights(surf_colours : np.ndarray, lights : Lights, points : np.ndarray, eye : np.ndarray, normals : np.ndarray, shadowed = None, idx = None, coefficients = None):
+    idx = np.arange(len(lights)) if idx is None else idx
+    n = len(points)
+    dtype = points.dtype
+    surf_colours = np.broadcast_to(np.asarray(surf_colours, dtype), (n, 3))
+    coefficients = np.broadcast_to(np.asarray(PHONG if coefficients is None else coefficients, dtype), (n, 4))
+    eye = np.broadcast_to(np.asarray(eye, dtype), (n, 4))
+    result = np.zeros((n, 3), dtype)
+    if len(idx) == 0:
+        return result
+    positions, intensities, radii = (a[idx].astype(dtype) for a in (lights.positions, lights.intensities, lights.radii))
+    step = max(1, lights.chunk//len(idx))
+    for i in range(0, n, step):
+        part = slice(i, i+step)
+        result[part] = phong(surf_colours[part], coefficients[part], positions, intensities, radii, points[part], eye[part],
+                             normals[part], None if shadowed is None else shadowed[part])
+    return result
+
+# Модель Фонга для n точек с коэффициентами (n,4) и k источников: составляющие (n,k,3), суммированные по источникам
+def phong(surf_colours, coefficients, positions, intensities, radii, points, eye, normals, shadowed):
+    ka, kd, ks, shininess = (coefficients[:,None,k:k+1] for k in range(4))
+    source_vecs = positions[None] - points[:,None]
+    distances = np.sqrt(np.sum(source_vecs*source_vecs, axis = 2))
+    source_colours = np.broadcast_to(intensities, source_vecs.shape[:2]+(3,))
+    if np.any(radii < np.inf):
+        source_colours = source_colours * falloff(distances, radii)[:,:,None]
+    eff_colours = surf_colours[:,None] * source_colours
+    ambient = ka * eff_colours
+    source_vecs /= distances[:,:,None]
+    eye_vecs = eye - points
+    eye_vecs /= np.sqrt(np.sum(eye_vecs*eye_vecs, axis = 1))[:,None]
+    ldn = np.sum(source_vecs*normals[:,None], axis = 2)
+    lit = ldn >= 0.0
+    if shadowed is not None:
+        lit &= ~shadowed
+    refl_vecs = reflect_arrays(-source_vecs, normals[:,None])
+    rde = np.sum((refl_vecs*eye_vecs[:,None])[...,:3], axis = 2)
+    shiny = lit & (rde > 0.0)
+    result = ambient + np.where(lit[:,:,None], kd * eff_colours * ldn[:,:,None], 0.0)
+    result += np.where(shiny[:,:,None], ks * source_colours * np.power(np.where(shiny, rde, 0.0), shininess[:,:,0])[:,:,None], 0.0)
+    return np.sum(result, axis = 1)
+
+
+
+# Перевод цветовых данных в байты изображения
+def quantise(img_data : np.ndarray):
+    np.clip(img_data, 0.0, 1.0, img_data)
+    return (255.0*img_data).astype(np.uint8)
+
 
 
 # Класс перспективной камеры
 class Eye(Body):
     origin = np.array(( 0.0,  0.0,  0.0,  1.0))
     fov : float
+    # Параметры отрисовки: тени, предельная глубина отражений и минимальный вклад отражённого луча
+    shadows = True
+    max_depth = 5
+    cutoff = 1e-3
+    # Точность пакетной отрисовки: np.float32 вдвое сокращает объём массивов лучей и кадра,
+    # эталонный попиксельный обход всегда идёт в float64
+    dtype = np.float64
+    # Отсечение первичных лучей по экранным прямоугольникам описанных сфер тел: каждое тело
+    # проверяется только лучами своего прямоугольника; если в прямоугольник кадра попадает
+    # больше cull_limit тел, первичные лучи идут через иерархию объёмов
+    culling = True
+    cull_limit = 2048
     
     def __init__(self, fov = 90.0, transform = None):
         super().__init__(transform)
@@ -80,19 +152,415 @@ class Eye(Body):
                     dirc += self.hor_inc
                     # Возвращение величины 3*индекс_пикселя упрощает расчеты в функции рендера
                     yield 3*(y*self.width+x), (Ray.make(self.root.origin, dirc)*self.root.transform).normalised()
-    
+
+        # Все лучи сетки одним пакетом в порядке обхода __iter__
+        # rect = (x0, y0, x1, y1) ограничивает пакет прямоугольником пикселей
+        def ray_batch(self, rect = None):
+            x0, y0, x1, y1 = (0, 0, self.width, self.height) if rect is None else rect
+            # Накопительная сумма повторяет последовательные прибавления hor_inc в __iter__
+            steps = np.empty((y1-y0, x1+1, 4))
+            steps[:,0] = self.anchor+np.arange(y0, y1)[:,None]*self.ver_inc
+            steps[:,1:] = self.hor_inc
+            dircs = np.cumsum(steps, axis = 1)[:,x0+1:].reshape((-1, 4))
+            return (RayBatch.make(self.root.origin, dircs)*self.root.transform).normalised().astype(self.root.dtype)
+
+        # Пакет лучей через точки, смещённые от центров пикселей (xs, ys) на доли шага сетки
+        # offsets (N,2) - смещения по горизонтали и вертикали в долях hor_inc и ver_inc
+        def jittered_batch(self, xs, ys, offsets):
+            dircs = (self.anchor+(xs+1+offsets[:,0])[:,None]*self.hor_inc
+                                +(ys+offsets[:,1])[:,None]*self.ver_inc)
+            return (RayBatch.make(self.root.origin, dircs)*self.root.transform).normalised().astype(self.root.dtype)
+
     # Основной метод, отрисовка сцены с данным разрешением
-    def render(self, scene : Scene, width : int, height : int):
+    # backend = 'batch' - векторная обработка всего кадра, 'grid' - эталонный попиксельный обход,
+    # 'parallel' - отрисовка плитками tile_size в workers процессах
+    # stats = True включает сбор статистики, тогда возвращается пара (изображение, RenderStats);
+    # пакетная отрисовка при этом идёт плитками tile_size, чтобы замерить стоимость каждой
+    # dtype задаёт точность этой отрисовки вместо Eye.dtype
+    # sink - приёмник из sinks.py: готовые плитки кадра сразу уходят в него, и кадр целиком
+    # в памяти не собирается; тогда вместо изображения возвращается сам приёмник
+    def render(self, scene : Scene, width : int, height : int, backend = 'batch', tile_size = 64, workers = None, stats = False, dtype = None, sink = None):
+        if dtype is not None and np.dtype(dtype) != np.dtype(self.dtype):
+            eye = copy.copy(self)
+            eye.dtype = dtype
+            return eye.render(scene, width, height, backend, tile_size, workers, stats, sink = sink)
+        stats = RenderStats(width, height) if stats else None
+        if sink is not None:
+            if backend == 'parallel':
+                parts = render_parallel_tiles(self, scene, width, height, tile_size, workers, stats)
+            elif backend == 'batch':
+                parts = self.render_tiles(scene, width, height, tile_size, stats)
+            else:
+                raise ValueError(f'render backend {backend} does not support sinks')
+            with sink:
+                for rect, pixels in parts:
+                    sink.write(rect, pixels)
+            return sink if stats is None else (sink, stats)
+        if backend == 'parallel':
+            image = render_parallel(self, scene, width, height, tile_size, workers, stats)
+            return image if stats is None else (image, stats)
+        if backend == 'batch' and stats is None:
+            img_data = self.render_batch(scene, width, height)
+        elif backend == 'batch':
+            image = np.empty((height, width, 3), np.uint8)
+            for (x0, y0, x1, y1), pixels in self.render_tiles(scene, width, height, tile_size, stats):
+                image[y0:y1, x0:x1] = pixels
+            return image, stats
+        elif backend == 'grid':
+            img_data = self.render_grid(scene, width, height, stats)
+            if stats is not None:
+                stats.add_tile((0, 0, width, height), sum(stats.times.values()))
+        else:
+            raise ValueError(f'unknown render backend: {backend}')
+        image = quantise(img_data).reshape((height, width, 3))
+        return image if stats is None else (image, stats)
+
+    # Генератор пар (rect, pixels) по плиткам tile_size, pixels - байты плитки (h,w,3)
+    # Экранные прямоугольники тел для отсечения считаются один раз на кадр
+    def render_tiles(self, scene : Scene, width : int, height : int, tile_size = 64, stats = None):
+        with timed(stats, 'intersection'):
+            rects = self.screen_rects(scene, width, height) if self.culling else None
+        for rect in tiles(width, height, tile_size):
+            x0, y0, x1, y1 = rect
+            t0 = time.perf_counter()
+            pixels = quantise(self.render_batch(scene, width, height, rect, stats, rects)).reshape((y1-y0, x1-x0, 3))
+            if stats is not None:
+                stats.add_tile(rect, time.perf_counter()-t0)
+            yield rect, pixels
+
+    # Попиксельная отрисовка через GridIterator
+    def render_grid(self, scene : Scene, width : int, height : int, stats = None):
+        # Тела без цвета отвергаются так же, как в пакетной отрисовке
+        scene.material_table()
         img_data = np.empty(3*width*height, float)
-        blank = np.zeros(3, int)
         for i, ray in self.GridIterator(self, width, height):
-            hit = ray.cast_into(scene)
+            img_data[i:i+3] = self.shade_ray(scene, ray, stats)
+        return img_data
+
+    # Цвет одиночного луча с учётом отражений, эталон для shade_batch
+    def shade_ray(self, scene : Scene, ray : Ray, stats = None):
+        pixel = np.zeros(3)
+        weight = 1.0
+        eye = np.matmul(self.origin, self.transform)
+        for depth in range(self.max_depth+1):
+            with timed(stats, 'intersection'):
+                hit = scene.cast(ray, stats = stats)
+            if stats is not None:
+                stats.count_rays('reflection' if depth else 'primary', 1, int(hit is not None))
             if hit == None:
-                pixel = blank
+                break
+            point = ray.loc_at_t(hit.t)
+            normal_array = hit.body.normal_array_at(point, hit.face)
+            surface = np.zeros(3)
+            for source in scene.lights.sources:
+                light_pos = source.position.data
+                with timed(stats, 'shadows'):
+                    shadowed = (self.shadows and np.dot(light_pos-point, normal_array) >= 0.0
+                                and scene.occluded(point, normal_array, light_pos, stats))
+                with timed(stats, 'shading'):
+                    surface += lighting(hit.body.colour_at(hit.face), source, point, eye, normal_array, shadowed, hit.body.material)
+            pixel += weight*surface
+            weight *= hit.body.material.reflectivity
+            if depth == self.max_depth or weight <= self.cutoff:
+                break
+            # Отражённый луч выпускается с той стороны поверхности, с которой пришёл падающий
+            facing = normal_array if np.dot(ray.direction, normal_array) < 0.0 else -normal_array
+            ray = Ray.make(point+OFFSET*facing, reflect_array(ray.direction, normal_array))
+            eye = ray.origin
+        return pixel
+
+    # Отрисовка с адаптивным сглаживанием: после одного луча на пиксель дополнительные
+    # samples лучей со случайным смещением внутри пикселя выпускаются только для пикселей на краях -
+    # там, где соседний пиксель видит другое тело или отличается цветом больше, чем на threshold
+    # Возвращает изображение и число потраченных дополнительных лучей
+    def render_adaptive(self, scene : Scene, width : int, height : int, samples = 4, threshold = 0.1, seed = 0):
+        grid = self.GridIterator(self, width, height)
+        colours, ids = self.trace_batch(scene, grid.ray_batch(), screen = (width, height, (0, 0, width, height)))
+        colours = colours.reshape((height, width, 3))
+        ids = ids.reshape((height, width))
+        edges = np.zeros((height, width), bool)
+        for axis in (0, 1):
+            differs = np.any(np.abs(np.diff(colours, axis = axis)) > threshold, axis = 2)
+            differs |= np.diff(ids, axis = axis) != 0
+            lead = [slice(None)]*2
+            lead[axis] = slice(None, -1)
+            edges[tuple(lead)] |= differs
+            lead[axis] = slice(1, None)
+            edges[tuple(lead)] |= differs
+        ys, xs = np.nonzero(edges)
+        if len(ys):
+            rng = np.random.default_rng(seed)
+            offsets = rng.uniform(-0.5, 0.5, (samples*len(ys), 2))
+            extra = self.shade_batch(scene, grid.jittered_batch(np.repeat(xs, samples), np.repeat(ys, samples), offsets))
+            total = colours[ys, xs]+extra.reshape((len(ys), samples, 3)).sum(axis = 1)
+            colours[ys, xs] = total/(samples+1)
+        return quantise(colours), samples*len(ys)
+
+    # Постепенная отрисовка: генератор пар (rect, pixels) по мере готовности плиток
+    # passes - шаги прореживания от грубого к точному, например (8, 4, 2, 1): на проходе с шагом s
+    # считается каждый s-й пиксель плитки, а блоки s*s до уточнения заполняются его цветом
+    # Плитки пишутся в image (uint8, height*width*3), pixels - срез image по rect
+    # budget - ограничение времени в секундах, после которого генератор останавливается;
+    # image при этом остаётся целым изображением с уже посчитанными проходами
+    def render_iter(self, scene : Scene, width : int, height : int, tile_size = 64, passes = (1,), image = None, budget = None):
+        if image is None:
+            image = np.zeros((height, width, 3), np.uint8)
+        done = np.zeros((height, width), bool)
+        grid = self.GridIterator(self, width, height)
+        deadline = None if budget is None else time.perf_counter()+budget
+        for step in passes:
+            for rect in tiles(width, height, tile_size):
+                if deadline is not None and time.perf_counter() > deadline:
+                    return
+                x0, y0, x1, y1 = rect
+                ys, xs = np.mgrid[0:y1-y0, 0:x1-x0]
+                tile = image[y0:y1, x0:x1]
+                tile_done = done[y0:y1, x0:x1]
+                todo = (ys % step == 0) & (xs % step == 0) & ~tile_done
+                if todo.any():
+                    colours = self.shade_batch(scene, grid.ray_batch(rect)[todo.reshape(-1)])
+                    tile[todo] = quantise(colours)
+                    tile_done |= todo
+                if step > 1:
+                    # Непосчитанные пиксели берут цвет опорного пикселя своего блока
+                    rest = ~tile_done
+                    tile[rest] = tile[ys[rest]-ys[rest] % step, xs[rest]-xs[rest] % step]
+                yield rect, tile
+
+    # Асинхронный вариант render_iter: плитки считаются в отдельном потоке, не блокируя цикл событий
+    # Отмена задачи останавливает генератор после текущей плитки
+    async def render_async(self, scene : Scene, width : int, height : int, **options):
+        gen = self.render_iter(scene, width, height, **options)
+        executor = ThreadPoolExecutor(1)
+        future = None
+        try:
+            while True:
+                future = executor.submit(next, gen, None)
+                item = await asyncio.wrap_future(future)
+                if item is None:
+                    return
+                yield item
+        finally:
+            if future is not None and not future.done():
+                future.add_done_callback(lambda f : gen.close())
             else:
-                point = ray.loc_at_t(hit.t)
-                normal_array = hit.body.normal_array_at(point)
-                pixel = lighting(hit.body.colour, scene.light, point, self.origin*self.transform, normal_array)
-            img_data[i:i+3] = pixel
-        np.clip(img_data, 0.0, 1.0, img_data)
-        return (255.0*img_data).astype(np.uint8).reshape((height, width, 3))
+                gen.close()
+            executor.shutdown(wait = False)
+
+    # Отрисовка кадра или прямоугольника rect массивами
+    # rects - экранные прямоугольники тел screen_rects всего кадра, если они уже посчитаны для других плиток
+    def render_batch(self, scene : Scene, width : int, height : int, rect = None, stats = None, rects = None):
+        rect = (0, 0, width, height) if rect is None else rect
+        with timed(stats, 'camera_rays'):
+            batch = self.GridIterator(self, width, height).ray_batch(rect)
+        return self.shade_batch(scene, batch, stats, (width, height, rect, rects)).reshape(-1)
+
+    # Цвета пакета лучей с отражениями, считаются волнами: после каждого отскока
+    # лучи, попавшие в отражающие тела, собираются в новый плотный пакет
+    # Луч выбывает на глубине max_depth или когда его вклад в пиксель падает ниже cutoff
+    # screen = (width, height, rect) указывает, что пакет - лучи сетки камеры в прямоугольнике rect,
+    # тогда первичные лучи проходят экранное отсечение cast_screen; четвёртым элементом может
+    # идти готовый результат screen_rects для кадра
+    def shade_batch(self, scene : Scene, batch : RayBatch, stats = None, screen = None):
+        return self.trace_batch(scene, batch, stats, screen)[0]
+
+    # Цвета пакета лучей вместе с номерами тел, в которые попали исходные лучи (-1 - промах)
+    # Считается в два прохода: геометрический geometry_batch и освещение его слоёв
+    def trace_batch(self, scene : Scene, batch : RayBatch, stats = None, screen = None):
+        layers = self.geometry_batch(scene, batch, stats, screen)
+        colours = light_layers(layers, scene.light, len(batch), scene if self.shadows else None, stats)
+        primary_ids = np.full(len(batch), -1)
+        if layers:
+            primary_ids[layers[0].pixel] = layers[0].body
+        return colours, primary_ids
+
+    # Геометрический проход: попадания пакета лучей и их отражений без освещения
+    # Возвращает список слоёв Layer по глубинам отражений, пиксели - номера лучей исходного пакета
+    def geometry_batch(self, scene : Scene, batch : RayBatch, stats = None, screen = None):
+        layers = []
+        if not scene.bodies:
+            return layers
+        dtype = batch.dtype
+        table = scene.material_table()
+        pixels = np.arange(len(batch))
+        weights = np.ones(len(batch), dtype)
+        origins = np.broadcast_to(np.matmul(self.origin, self.transform).astype(dtype), (len(batch), 4))
+        for depth in range(self.max_depth+1):
+            with timed(stats, 'intersection'):
+                if depth == 0 and screen is not None and self.culling:
+                    t, ids, faces = self.cast_screen(scene, batch, *screen, stats = stats)
+                else:
+                    t, ids, faces = scene.cast_batch(batch, stats = stats)
+            hit = np.nonzero(ids >= 0)[0]
+            if stats is not None:
+                stats.count_rays('reflection' if depth else 'primary', len(batch), len(hit))
+            ids, faces = ids[hit], faces[hit]
+            points = batch[hit].loc_at_t(t[hit])
+            normals = self.hit_normals(scene, points, ids, faces, stats)
+            rows = table.rows(scene.bodies, ids, faces)
+            layers.append(Layer(pixels[hit], weights[hit], t[hit], points, normals, ids,
+                                table.colours[rows].astype(dtype), origins[hit], table.phong[rows].astype(dtype)))
+            if depth == self.max_depth:
+                break
+            weights = weights[hit]*table.reflectivity[rows].astype(dtype)
+            keep = np.nonzero(weights > self.cutoff)[0]
+            if len(keep) == 0:
+                break
+            dirs = batch.directions[hit[keep]]
+            normals = normals[keep]
+            facing = np.where((np.sum(dirs*normals, axis = 1) < 0.0)[:,None], normals, -normals)
+            batch = RayBatch(points[keep]+offset(dtype)*facing, reflect_arrays(dirs, normals))
+            pixels = pixels[hit[keep]]
+            weights = weights[keep]
+            origins = batch.origins
+        return layers
+
+    # Экранные прямоугольники (B,4) пикселей x0, y0, x1, y1 описанных сфер тел в кадре width x height
+    # Границы проекции сферы по каждой оси - наклоны касательных к ней плоскостей через камеру;
+    # тела позади камеры и вне пирамиды видимости получают пустые прямоугольники, а сферы,
+    # задевающие плоскость камеры, занимают весь кадр
+    def screen_rects(self, scene : Scene, width : int, height : int):
+        centres, radii = scene.bounding_spheres()
+        local = np.matmul(centres, self.inv_transform[:3,:3])+self.inv_transform[3,:3]
+        radii = radii*np.linalg.norm(self.inv_transform[:3,:3], 2)
+        depth = -local[:,2]
+        rects = np.tile((0, 0, width, height), (len(radii), 1))
+        rects[depth < -radii] = 0
+        ahead = np.nonzero(depth > radii)[0]
+        d, r = depth[ahead], radii[ahead]
+        span = d*d-r*r
+        bounds = []
+        for axis in (0, 1):
+            c = local[ahead, axis]
+            root = r*np.sqrt(c*c+span)
+            bounds.append(((c*d-root)/span, (c*d+root)/span))
+        rects[ahead] = self.plane_rects(*bounds, width, height)
+        return rects
+
+    # Прямоугольники пикселей (K,4) x0, y0, x1, y1 кадра width x height, накрывающие прямоугольники
+    # плоскости камеры z = -1 с границами u = (u0, u1) и v = (v0, v1) - массивами (K,) наклонов x/глубина
+    # и y/глубина в её системе координат
+    def plane_rects(self, u, v, width : int, height : int):
+        grid = self.GridIterator(self, width, height)
+        # Координаты пикселей по направлениям сетки anchor+(x+1)*hor_inc+y*ver_inc, с запасом в пиксель
+        xs = [(b-grid.anchor[0])/grid.hor_inc[0]-1.0 for b in u]
+        ys = [(b-grid.anchor[1])/grid.ver_inc[1] for b in v]
+        return np.stack((np.clip(np.floor(np.minimum(*xs))-1, 0, width), np.clip(np.floor(np.minimum(*ys))-1, 0, height),
+                         np.clip(np.ceil(np.maximum(*xs))+2, 0, width), np.clip(np.ceil(np.maximum(*ys))+2, 0, height)), axis = 1).astype(int)
+
+    # Ближайшие пересечения лучей сетки камеры в прямоугольнике rect кадра width x height,
+    # как у Scene.cast_batch: тела вне rect отсекаются, а остальные проверяются только лучами,
+    # попавшими в их экранные прямоугольники
+    # rects - готовый результат screen_rects, иначе прямоугольники считаются здесь
+    def cast_screen(self, scene : Scene, batch : RayBatch, width : int, height : int, rect, rects = None, stats = None):
+        x0, y0, x1, y1 = rect
+        rects = self.screen_rects(scene, width, height) if rects is None else rects
+        lo = np.maximum(rects[:,:2], (x0, y0))-(x0, y0)
+        hi = np.minimum(rects[:,2:], (x1, y1))-(x0, y0)
+        bodies = np.nonzero(np.all(hi > lo, axis = 1))[0]
+        if len(bodies) > self.cull_limit:
+            return scene.cast_batch(batch, stats = stats)
+        t = np.full(len(batch), np.inf, batch.dtype)
+        ids = np.full(len(batch), -1)
+        faces = np.full(len(batch), -1)
+        for i in bodies:
+            idx = (np.arange(lo[i,1], hi[i,1])[:,None]*(x1-x0)+np.arange(lo[i,0], hi[i,0])).reshape(-1)
+            if stats is not None:
+                stats.count_tests(scene.bodies[i], len(idx))
+            body_t, body_faces = scene.bodies[i].hit_batch(batch[idx])
+            closer = body_t < t[idx]
+            idx = idx[closer]
+            t[idx], ids[idx], faces[idx] = body_t[closer], i, body_faces[closer]
+        return t, ids, faces
+
+    # Геометрический буфер кадра или прямоугольника rect для последующего GBuffer.relight
+    def capture(self, scene : Scene, width : int, height : int, rect = None, stats = None):
+        rect = (0, 0, width, height) if rect is None else rect
+        with timed(stats, 'camera_rays'):
+            batch = self.GridIterator(self, width, height).ray_batch(rect)
+        return GBuffer(width, height, rect, self.geometry_batch(scene, batch, stats, (width, height, rect)), self.shadows, scene)
+
+    # Освещённость поверхностей, в которые попал пакет лучей
+    # eye - точка наблюдения (4,) или массив (N,4) начал лучей
+    # Возвращает индексы попавших лучей, номера тел, точки, нормали и цвета для них
+    def surface_batch(self, scene : Scene, batch : RayBatch, eye : np.ndarray, stats = None):
+        with timed(stats, 'intersection'):
+            hits = scene.cast_batch(batch, stats = stats)
+        return self.shade_hits(scene, batch, *hits, eye, stats)
+
+    # Освещённость по найденным пересечениям: массивам t, номеров тел и граней из Scene.cast_batch
+    def shade_hits(self, scene : Scene, batch : RayBatch, t, ids, faces, eye : np.ndarray, stats = None):
+        hit = np.nonzero(ids >= 0)[0]
+        ids, faces = ids[hit], faces[hit]
+        points = batch[hit].loc_at_t(t[hit])
+        if eye.ndim > 1:
+            eye = eye[hit]
+        normals = self.hit_normals(scene, points, ids, faces, stats)
+        table = scene.material_table()
+        rows = scene.material_rows(ids, faces)
+        surface = light_points(scene.lights, table.colours[rows], points, eye, normals, ids,
+                               scene if self.shadows else None, stats, table.phong[rows])
+        return hit, ids, points, normals, surface
+
+    # Нормали в точках попаданий, тела обрабатываются группами
+    def hit_normals(self, scene : Scene, points, ids, faces, stats = None):
+        normals = np.empty_like(points)
+        with timed(stats, 'normals'):
+            for i in np.unique(ids):
+                idx = np.nonzero(ids == i)[0]
+                normals[idx] = scene.bodies[i].normal_arrays_at(points[idx], faces[idx])
+        return normals
+
+
+
+# Маска (N,K) пар точка-источник для точек тел receivers и источников lights с номерами idx,
+# в которых источник перекрыт; теневые лучи всех пар, где точка обращена к источнику
+# и лежит в пределах его радиуса действия, проверяются одним пакетом
+def shadow_mask(scene : Scene, lights : Lights, points, normals, receivers, idx, stats = None):
+    shadowed = np.zeros((len(points), len(idx)), bool)
+    with timed(stats, 'shadows'):
+        positions, radii = lights.positions[idx].astype(points.dtype), lights.radii[idx]
+        source_vecs = positions[None]-points[:,None]
+        facing = np.sum(source_vecs*normals[:,None], axis = 2) >= 0.0
+        if np.any(radii < np.inf):
+            facing &= np.sum(source_vecs*source_vecs, axis = 2) < radii**2
+        pi, ki = np.nonzero(facing)
+        # Для одного источника передаётся его положение, и проверка использует кэш перекрывающих тел
+        light_pos = positions[0] if len(idx) == 1 else positions[ki]
+        shadowed[pi, ki] = scene.occluded_batch(points[pi], normals[pi], light_pos, receivers[pi], stats)
+    return shadowed
+
+# Освещение точек тел receivers: точки делятся на ячейки, и для каждой отсекаются источники,
+# не дающие в неё заметного вклада; тени ищутся по сцене scene, без неё точки считаются освещёнными
+# coefficients - коэффициенты модели Фонга точек (N,4), по умолчанию PHONG
+def light_points(light, colours, points, eye, normals, receivers, scene : Scene = None, stats = None, coefficients = None):
+    lights = Lights.of(light)
+    colours = np.broadcast_to(colours, (len(points), 3))
+    coefficients = np.broadcast_to(PHONG if coefficients is None else coefficients, (len(points), 4))
+    result = np.zeros((len(points), 3), points.dtype)
+    for part in lights.cells(points):
+        if len(part) == 0:
+            continue
+        cell = points[part]
+        # Фоновая и рассеянная составляющие пропорциональны цвету поверхности, бликовая - нет
+        # Неизвестный (NaN) цвет оценивается как белый, чтобы не отсечь источники всей ячейки
+        brightness = np.max(np.nan_to_num(colours[part], nan = 1.0), axis = 1)
+        gain = np.max((coefficients[part,0]+coefficients[part,1])*brightness+coefficients[part,2])
+        idx = lights.visible(cell[:,:3].min(axis = 0), cell[:,:3].max(axis = 0), gain)
+        shadowed = None
+        if scene is not None:
+            shadowed = shadow_mask(scene, lights, cell, normals[part], receivers[part], idx, stats)
+        with timed(stats, 'shading'):
+            result[part] = lighting_lights(colours[part], lights, cell, eye if eye.ndim == 1 else eye[part],
+                                           normals[part], shadowed, idx, coefficients[part])
+    return result
+
+# Освещение слоёв геометрического прохода источником или набором источников light,
+# результат - цвета n пикселей (n,3)
+def light_layers(layers, light, n, scene : Scene = None, stats = None):
+    lights = Lights.of(light)
+    colours = np.zeros((n, 3), layers[0].position.dtype if layers else float)
+    for layer in layers:
+        surface = light_points(lights, layer.colour, layer.position, layer.origin, layer.normal, layer.body, scene, stats, layer.phong)
+        colours[layer.pixel] += layer.weight[:,None]*surface
+    return colours
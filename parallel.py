@@ -0,0 +1,96 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import time
+
+
+
+# Состояние процесса-исполнителя: сцена, камера и кадровый буфер передаются один раз при его запуске
+# Без shm_name кадрового буфера нет, и плитки возвращаются родительскому процессу
+# Экранные прямоугольники тел для отсечения считаются один раз на процесс, а не для каждой плитки
+worker_state = {}
+
+def init_worker(eye, scene, width, height, shm_name = None):
+    rects = eye.screen_rects(scene, width, height) if eye.culling else None
+    worker_state.update(eye = eye, scene = scene, width = width, height = height, rects = rects)
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name = shm_name)
+        worker_state.update(shm = shm, framebuffer = np.ndarray((height, width, 3), np.uint8, buffer = shm.buf))
+
+# Байты одной плитки (y1-y0, x1-x0, 3) и её статистика, если with_stats, иначе None
+def tile_pixels(rect, with_stats = False):
+    from optics import quantise
+    from stats import RenderStats
+    s = worker_state
+    x0, y0, x1, y1 = rect
+    stats = RenderStats() if with_stats else None
+    t0 = time.perf_counter()
+    pixels = s['eye'].render_batch(s['scene'], s['width'], s['height'], rect, stats, s['rects'])
+    pixels = quantise(pixels).reshape((y1-y0, x1-x0, 3))
+    if stats is not None:
+        stats.add_tile(rect, time.perf_counter()-t0)
+    return pixels, stats
+
+# Отрисовка одной плитки прямо в общий кадровый буфер
+# При with_stats возвращается статистика плитки, иначе None
+def render_tile(rect, with_stats = False):
+    x0, y0, x1, y1 = rect
+    pixels, stats = tile_pixels(rect, with_stats)
+    worker_state['framebuffer'][y0:y1, x0:x1] = pixels
+    return stats
+
+# Отрисовка плитки с возвратом её байтов: тройка (rect, pixels, stats)
+def render_tile_data(rect, with_stats = False):
+    return (rect,)+tile_pixels(rect, with_stats)
+
+# Разбиение кадра на плитки (x0, y0, x1, y1) размера tile_size
+# tile_size - сторона квадратной плитки или пара (ширина, высота), например (width, 1) для строк
+def tiles(width, height, tile_size):
+    tile_w, tile_h = (tile_size, tile_size) if np.isscalar(tile_size) else tile_size
+    return [(x, y, min(x+tile_w, width), min(y+tile_h, height))
+            for y in range(0, height, tile_h)
+            for x in range(0, width, tile_w)]
+
+# Многопроцессная отрисовка плитками
+# Плитки выдаются свободным исполнителям по одной из общей очереди пула,
+# поэтому дорогие участки кадра не задерживают остальные процессы
+# stats - необязательная RenderStats, в которую сливается статистика всех плиток
+def render_parallel(eye, scene, width, height, tile_size = 64, workers = None, stats = None):
+    workers = workers or os.cpu_count()
+    shm = shared_memory.SharedMemory(create = True, size = 3*width*height)
+    try:
+        with ProcessPoolExecutor(workers, initializer = init_worker,
+                                 initargs = (eye, scene, width, height, shm.name)) as executor:
+            futures = [executor.submit(render_tile, rect, stats is not None) for rect in tiles(width, height, tile_size)]
+            for future in as_completed(futures):
+                tile_stats = future.result()
+                if stats is not None:
+                    stats.merge(tile_stats)
+        return np.ndarray((height, width, 3), np.uint8, buffer = shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+# Многопроцессная отрисовка плитками без общего кадрового буфера: генератор пар (rect, pixels)
+# в порядке готовности; в работе одновременно не больше 2*workers плиток, так что память
+# ограничена размером плиток, а не кадра
+def render_parallel_tiles(eye, scene, width, height, tile_size = 64, workers = None, stats = None):
+    workers = workers or os.cpu_count()
+    rects = iter(tiles(width, height, tile_size))
+    with ProcessPoolExecutor(workers, initializer = init_worker,
+                             initargs = (eye, scene, width, height)) as executor:
+        pending = set()
+        while True:
+            for rect in rects:
+                pending.add(executor.submit(render_tile_data, rect, stats is not None))
+                if len(pending) >= 2*workers:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                rect, pixels, tile_stats = future.result()
+                if stats is not None:
+                    stats.merge(tile_stats)
+                yield rect, pixels
@@ -1,23 +1,248 @@
+from bodies import apply_all
+from bvh import BVH, box_spheres
+from lights import Lights
+from materials import Material, MaterialTable
 from optics import *
 from spatial import *
+from utils import *
 
 class Scene:
     bodies : list
+    bvh_cache : BVH
+    shadow_cache : dict
+    sphere_cache : tuple
+    material_cache : tuple
+    hash_cache : tuple
+    refit_limit = 0.25
+    # Для скольких последних положений источников хранятся перекрывавшие их тела
+    shadow_lights = 16
 
     def __init__(self, bodies, light, camera):
         self.bodies = bodies
-        self.light = light
+        # Список источников упаковывается в набор Lights
+        self.light = Lights(light) if isinstance(light, (list, tuple)) else light
         self.camera = camera
+        self.bvh_cache = None
+        self.shadow_cache = {}
+        self.sphere_cache = None
+        self.material_cache = None
+        self.hash_cache = None
     
     def __iadd__(self, bodies):
         self.add_bodies(bodies)
+        return self
     
     def add_bodies(self, bodies):
         if not type(bodies) == list:
             bodies = [bodies]
         self.bodies += bodies
+        self.invalidate()
     
     def apply(self, transform : Mat4):
+        apply_all(self.bodies, transform)
+        self.invalidate()
+        return self
+
+    # Сброс иерархии объёмов после изменения геометрии, она перестроится при следующем обращении
+    def invalidate(self):
+        self.bvh_cache = None
+        self.shadow_cache = {}
+        self.sphere_cache = None
+        self.material_cache = None
+        self.hash_cache = None
+
+    # Обновление после перемещения тел с номерами moved: пока их доля не больше refit_limit,
+    # границы узлов иерархии пересчитываются без перестройки, иначе она строится заново
+    def update(self, moved):
+        moved = list(moved)
+        if self.bvh_cache is None or len(self.bvh_cache) != len(self.bodies) or len(moved) > self.refit_limit*len(self.bodies):
+            self.invalidate()
+        elif moved:
+            self.bvh_cache.refit([self.bodies[i].world_bounds() for i in moved], moved)
+            self.sphere_cache = None
+            self.hash_cache = None
+
+    # Иерархия объёмов над мировыми параллелепипедами тел, строится лениво
+    @property
+    def bvh(self):
+        if self.bvh_cache is None:
+            self.bvh_cache = BVH(self.world_bounds())
+        return self.bvh_cache
+
+    # Мировые границы (B,2,3) и отражающая способность (B,) тел; ленивые наборы тел
+    # (scenefile.BodyTable) отдают их массивами, не создавая тел
+    def world_bounds(self):
+        if hasattr(self.bodies, 'world_bounds'):
+            return self.bodies.world_bounds()
+        return np.array([b.world_bounds() for b in self.bodies]).reshape((-1, 2, 3))
+
+    # Описанные сферы тел: центры (B,3) и радиусы (B,), считаются лениво
+    # Ленивые наборы тел дают сферы своих параллелепипедов, не создавая тел
+    def bounding_spheres(self):
+        if self.sphere_cache is None:
+            if hasattr(self.bodies, 'world_bounds'):
+                self.sphere_cache = box_spheres(self.bodies.world_bounds())
+            else:
+                spheres = [b.bounding_sphere() for b in self.bodies]
+                self.sphere_cache = (np.array([c for c, _ in spheres], float).reshape((-1, 3)),
+                                     np.array([r for _, r in spheres], float))
+        return self.sphere_cache
+
+    def reflectivities(self):
+        table = self.material_table()
+        return table.reflectivity[table.offsets]
+
+    # Таблица материалов MaterialTable тел сцены, пересобирается после изменения числа тел
+    # или атрибутов любого материала; замена самого объекта материала у тела требует invalidate
+    # Тело без цвета - ошибка ValueError
+    def material_table(self):
+        key = (Material.changes, len(self.bodies))
+        if self.material_cache is None or self.material_cache[0] != key:
+            if hasattr(self.bodies, 'material_table'):
+                table = self.bodies.material_table()
+            else:
+                table = MaterialTable.of_bodies(self.bodies)
+            # Без цвета освещение тела не определено, и такое тело затемнило бы весь кадр
+            missing = np.nonzero(np.isnan(table.colours).any(axis = 1))[0]
+            if len(missing):
+                raise ValueError(f'body {np.searchsorted(table.offsets, missing[0], "right")-1} has no colour')
+            self.material_cache = (key, table)
+        return self.material_cache[1]
+
+    # Источники сцены в виде набора Lights
+    @property
+    def lights(self):
+        return Lights.of(self.light)
+
+    # Ближайшее пересечение луча с телами сцены
+    # accelerated = False - полный перебор тел, как без иерархии
+    # stats - необязательная RenderStats для подсчёта проверок пересечений по типам тел
+    def cast(self, ray : Ray, accelerated = True, stats = None):
+        if not accelerated:
+            if stats is not None:
+                for b in self.bodies:
+                    stats.count_tests(b, 1)
+            return ray.cast_into_all(self.bodies)
+        found = {}
+        def test(prims):
+            best_t, best_i = np.inf, -1
+            for i in prims:
+                if stats is not None:
+                    stats.count_tests(self.bodies[i], 1)
+                hit = ray.find_hit(self.bodies[i].intersect(ray))
+                if hit is not None and hit.t < best_t:
+                    best_t, best_i, found[i] = hit.t, i, hit
+            return best_t, best_i
+        t, i = self.bvh.nearest(ray.origin, ray.direction, test)
+        return None if i < 0 else found[i]
+
+    # Ближайшие пересечения пакета лучей: массивы t (inf - промах), индексов тел и граней (-1 - промах)
+    # stats - необязательная RenderStats для подсчёта проверок пересечений по типам тел
+    def cast_batch(self, batch : RayBatch, accelerated = True, stats = None):
+        if accelerated:
+            return self.bvh.nearest_batch(batch, lambda prims, idx : self.hit_bodies(prims, batch[idx], stats))
+        if not self.bodies:
+            return np.full(len(batch), np.inf, batch.dtype), np.full(len(batch), -1), np.full(len(batch), -1)
+        t, ids, faces = self.hit_bodies(np.arange(len(self.bodies)), batch, stats)
+        ids[t == np.inf] = -1
+        return t, ids, faces
+
+    # Ближайшие пересечения пакета с телами из списка индексов prims
+    def hit_bodies(self, prims, batch : RayBatch, stats = None):
+        if stats is not None:
+            for i in prims:
+                stats.count_tests(self.bodies[i], len(batch))
+        hits = [self.bodies[i].hit_batch(batch) for i in prims]
+        ts = np.array([h[0] for h in hits])
+        k = np.argmin(ts, axis = 0)
+        n = np.arange(len(batch))
+        return ts[k, n], np.asarray(prims)[k], np.array([h[1] for h in hits])[k, n]
+
+    # Строки таблицы материалов для попаданий в тела ids по граням faces
+    def material_rows(self, ids, faces = None):
+        faces = np.full(len(ids), -1) if faces is None else faces
+        return self.material_table().rows(self.bodies, ids, faces)
+
+    # Цвета поверхности (N,3) тел с номерами ids в точках граней faces
+    def surface_colours(self, ids, faces = None):
+        return self.material_table().colours[self.material_rows(ids, faces)]
+
+    # Теневой луч от точки поверхности к источнику света, сдвинутый вдоль нормали
+    # Направление не нормализуется, так что источник лежит на луче при t = 1
+    def shadow_ray(self, point, normal, light_position):
+        origin = point+OFFSET*normal
+        return Ray.make(origin, light_position-origin)
+
+    # Проверка одиночной точки на затенённость телами, отбрасывающими тень
+    # stats считает теневой луч и его проверки так же, как occluded_batch
+    def occluded(self, point, normal, light_position, stats = None):
+        ray = self.shadow_ray(point, normal, light_position)
+        blocked = False
         for b in self.bodies:
-            b.apply(transform)
-        return self
\ No newline at end of file
+            if not b.casts_shadow:
+                continue
+            if stats is not None:
+                stats.count_tests(b, 1)
+            if any(0.0 <= t < 1.0 for t in b.find_intersections(ray)):
+                blocked = True
+                break
+        if stats is not None:
+            stats.count_rays('shadow', 1, int(blocked))
+        return blocked
+
+    # Затенённость точек (N,4): маска точек, от которых источник перекрыт
+    # light_position - положение источника (4,) или массив (N,4) своих источников для каждой точки
+    # receivers - номера тел, которым принадлежат точки; при одном источнике для каждого тела сначала
+    # проверяется тело, перекрывавшее ему этот источник в прошлый раз, а остальные лучи одним пакетом
+    # идут через иерархию объёмов и выбывают на первом же перекрытии
+    def occluded_batch(self, points, normals, light_position, receivers = None, stats = None):
+        light_position = np.asarray(light_position, points.dtype)
+        origins = points+offset(points.dtype)*normals
+        batch = RayBatch.make(origins, light_position-origins)
+        receivers = np.full(len(batch), -1) if receivers is None else receivers
+        blocked = np.zeros(len(batch), bool)
+        cached = light_position.ndim == 1
+        blockers = {}
+        if cached:
+            # Записи по положениям источника; недавно использованное положение переносится в конец,
+            # а самые старые вытесняются, чтобы кэш не рос при движении источника в анимации
+            light_key = light_position.tobytes()
+            blockers = self.shadow_cache.pop(light_key, {})
+            self.shadow_cache[light_key] = blockers
+            while len(self.shadow_cache) > self.shadow_lights:
+                del self.shadow_cache[next(iter(self.shadow_cache))]
+        for r in (np.unique(receivers) if cached else ()):
+            cached_body = blockers.get(r, -1)
+            # Тело могло перестать отбрасывать тень после того, как попало в кэш
+            if cached_body >= 0 and self.bodies[cached_body].casts_shadow:
+                idx = np.nonzero(receivers == r)[0]
+                blocked[idx] = self.bodies[cached_body].intersect_batch(batch[idx]) < 1.0
+                if stats is not None:
+                    stats.count_tests(self.bodies[cached_body], len(idx))
+        rest = np.nonzero(~blocked)[0]
+        rest_batch = batch[rest]
+        hit, blocker = self.bvh.any_batch(rest_batch, lambda prims, idx : self.shadow_test(prims, rest_batch[idx], stats), 1.0)
+        if stats is not None:
+            stats.count_rays('shadow', len(batch), int(blocked.sum()+hit.sum()))
+        blocked[rest[hit]] = True
+        if cached:
+            # Запоминается самое частое перекрывающее тело для каждого тела-приёмника
+            pairs, counts = np.unique(np.stack((receivers[rest[hit]], blocker[hit])), axis = 1, return_counts = True)
+            for k in np.argsort(counts):
+                blockers[pairs[0,k]] = pairs[1,k]
+        return blocked
+
+    # Перекрытие теневых лучей телами prims
+    def shadow_test(self, prims, batch : RayBatch, stats = None):
+        hit = np.zeros(len(batch), bool)
+        prim = np.full(len(batch), -1)
+        for i in prims:
+            if not self.bodies[i].casts_shadow:
+                continue
+            free = np.nonzero(~hit)[0]
+            if stats is not None:
+                stats.count_tests(self.bodies[i], len(free))
+            mask = self.bodies[i].intersect_batch(batch[free]) < 1.0
+            hit[free[mask]] = True
+            prim[free[mask]] = i
+        return hit, prim
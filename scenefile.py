@@ -0,0 +1,436 @@
+from bodies import Body, Box, Polyhedron, Quad, Sphere, SphereField, Triangle
+from lights import Lights, PointSource
+from materials import PHONG, Colour, Material, MaterialTable
+from optics import Eye
+from scene import Scene
+from spatial import *
+
+import copy
+import hashlib
+import json
+import pickle
+import re
+import struct
+
+
+
+# Файл сцены: сигнатура, длина заголовка, JSON-заголовок и выровненные массивы
+# Заголовок описывает массивы (тип, форма, смещение от начала данных) и параметры камеры,
+# массивы при загрузке отображаются в память и читаются системой по мере обращения
+MAGIC = b'TRSCENE1'
+ALIGN = 64
+
+# Типы тел файла; номер типа - позиция в списке
+BODY_TYPES = ('Sphere', 'Box', 'Quad', 'Triangle', 'Polyhedron', 'SphereField')
+
+def aligned(n):
+    return -(-n//ALIGN)*ALIGN
+
+# Запись словаря массивов arrays и словаря meta в файл path
+def write_container(path, arrays, meta = None):
+    table = {}
+    offset = 0
+    arrays = {name : np.ascontiguousarray(a) for name, a in arrays.items()}
+    for name, a in arrays.items():
+        table[name] = {'dtype' : a.dtype.str, 'shape' : list(a.shape), 'offset' : offset}
+        offset = aligned(offset+a.nbytes)
+    header = json.dumps({'arrays' : table, 'meta' : meta or {}}).encode()
+    start = aligned(len(MAGIC)+8+len(header))
+    with open(path, 'wb') as f:
+        f.write(MAGIC+struct.pack('<Q', len(header))+header)
+        for name, a in arrays.items():
+            f.seek(start+table[name]['offset'])
+            f.write(a.tobytes())
+        f.truncate(start+offset)
+
+# Чтение файла write_container: пара (массивы, meta); массивы отображаются в память только для чтения
+def read_container(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a scene file')
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size))
+    start = aligned(len(MAGIC)+8+size)
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, info['dtype'])
+        else:
+            arrays[name] = np.memmap(path, info['dtype'], 'r', start+info['offset'], shape)
+    return arrays, header['meta']
+
+
+
+# Упаковка сцены в массивы файла: пара (массивы, meta); camera = False не записывает камеру
+def scene_arrays(scene : Scene, camera = True):
+    bodies = list(scene.bodies)
+    n = len(bodies)
+    types = np.empty(n, np.uint8)
+    colours = np.full((n, 3), np.nan)
+    vertices, faces, centres, radii, colour_ids, palettes = [], [], [], [], [], []
+    ranges = {name : np.zeros((n, 2), np.int64) for name in ('vertex_range', 'face_range', 'field_range', 'palette_range')}
+    counts = dict.fromkeys(ranges, 0)
+    def put(name, k, parts, array):
+        parts.append(array)
+        ranges[name][k] = (counts[name], counts[name]+len(array))
+        counts[name] += len(array)
+    for k, b in enumerate(bodies):
+        name = type(b).__name__
+        if name not in BODY_TYPES:
+            raise ValueError(f'body type {name} cannot be saved to a scene file')
+        types[k] = BODY_TYPES.index(name)
+        if b.colour is not None:
+            colours[k] = b.colour.data[:3]
+        if isinstance(b, (Triangle, Quad)) and not b.std:
+            put('vertex_range', k, vertices, b.points[:,:3])
+        elif isinstance(b, Polyhedron):
+            put('vertex_range', k, vertices, b.points[:,:3])
+            put('face_range', k, faces, b.indices)
+        elif isinstance(b, SphereField):
+            put('field_range', k, centres, b.centres)
+            radii.append(b.radii)
+            colour_ids.append(b.colour_ids)
+            if b.palette is not None:
+                put('palette_range', k, palettes, b.palette)
+    lights = scene.lights
+    arrays = {'types' : types,
+              'transforms' : np.array([b.transform for b in bodies]).reshape((n, 4, 4)),
+              'inverses' : np.array([b.inv_transform for b in bodies]).reshape((n, 4, 4)),
+              'bounds' : np.array([b.world_bounds() for b in bodies]).reshape((n, 2, 3)),
+              'colours' : colours,
+              'reflectivity' : np.array([b.material.reflectivity for b in bodies], float),
+              'phong' : np.array([b.material.phong() for b in bodies]).reshape((n, 4)),
+              'shadows' : np.array([b.casts_shadow for b in bodies], bool),
+              'vertices' : np.concatenate(vertices or [np.empty((0, 3))]),
+              'faces' : np.concatenate(faces or [np.empty((0, 3), np.int64)]).astype(np.int64),
+              'field_centres' : np.concatenate(centres or [np.empty((0, 3))]),
+              'field_radii' : np.concatenate(radii or [np.empty(0)]),
+              'field_colours' : np.concatenate(colour_ids or [np.empty(0, np.int32)]).astype(np.int32),
+              'palettes' : np.concatenate(palettes or [np.empty((0, 3))]),
+              'light_positions' : lights.positions,
+              'light_intensities' : lights.intensities,
+              'light_radii' : lights.radii}
+    arrays.update(ranges)
+    eye = scene.camera if camera else None
+    meta = {'version' : 1, 'body_types' : list(BODY_TYPES)}
+    if eye is not None:
+        meta['camera'] = {'fov' : eye.fov, 'shadows' : eye.shadows, 'max_depth' : eye.max_depth, 'cutoff' : eye.cutoff}
+        arrays['camera'] = np.stack((eye.transform, eye.inv_transform))
+    return arrays, meta
+
+# Сохранение сцены в файл
+def save_scene(scene : Scene, path):
+    write_container(path, *scene_arrays(scene))
+
+# Копия сцены без камеры и кэшей пересечений - для передачи в другие процессы и на другие машины
+def detached(scene : Scene):
+    scene = copy.copy(scene)
+    scene.camera, scene.bvh_cache, scene.shadow_cache = None, None, {}
+    scene.sphere_cache, scene.material_cache = None, None
+    return scene
+
+# Канонические массивы тел для хэша: по телу - тип, преобразование и материал, данные геометрии
+# с отрезками тел в них; типы нормированы к BODY_TYPES, значения - к одним dtype, а производные
+# массивы (обратные матрицы, границы) не входят
+BODY_ARRAYS = {'types' : np.uint8, 'transforms' : float, 'colours' : float, 'reflectivity' : float,
+               'phong' : float, 'shadows' : bool, 'vertex_range' : np.int64, 'face_range' : np.int64,
+               'field_range' : np.int64, 'palette_range' : np.int64}
+DATA_ARRAYS = {'vertices' : (float, (0, 3)), 'faces' : (np.int64, (0, 3)), 'field_centres' : (float, (0, 3)),
+               'field_radii' : (float, (0,)), 'field_colours' : (np.int32, (0,)), 'palettes' : (float, (0, 3))}
+RANGE_DATA = {'vertex_range' : 'vertices', 'face_range' : 'faces', 'field_range' : 'field_centres', 'palette_range' : 'palettes'}
+# Поля тела, которые могут отличаться у созданного из файла тела от записанных значений
+BODY_FIELDS = ('transforms', 'colours', 'reflectivity', 'phong', 'shadows')
+
+# Массивы тел списка bodies в канонической форме
+def body_arrays(bodies):
+    arrays = scene_arrays(Scene(list(bodies), [], None), camera = False)[0]
+    return {**{name : np.asarray(arrays[name], dtype) for name, dtype in BODY_ARRAYS.items()},
+            **{name : np.asarray(arrays[name], dtype) for name, (dtype, _) in DATA_ARRAYS.items()}}
+
+# Массивы загруженного набора тел в канонической форме: массивы файла с умолчаниями для отсутствующих,
+# поверх которых записаны изменённые созданные тела, и тела, добавленные после загрузки
+def table_arrays(bodies):
+    file = bodies.arrays
+    n = len(file['types'])
+    types = np.array([BODY_TYPES.index(name) for name in bodies.body_types], np.uint8)[np.asarray(file['types'])]
+    defaults = {'colours' : np.full((n, 3), np.nan), 'reflectivity' : np.zeros(n), 'phong' : np.tile(PHONG, (n, 1)),
+                'shadows' : np.ones(n, bool)}
+    arrays = {'types' : types}
+    for name, dtype in BODY_ARRAYS.items():
+        if name != 'types':
+            arrays[name] = np.array(file[name], dtype) if name in file else np.asarray(defaults.get(name, np.zeros((n, 2))), dtype)
+    for name, (dtype, shape) in DATA_ARRAYS.items():
+        arrays[name] = np.asarray(file[name], dtype) if name in file else np.empty(shape, dtype)
+    for i, body in bodies.changes():
+        row = body_arrays([body])
+        for name in BODY_FIELDS:
+            arrays[name][i] = row[name][0]
+    if bodies.extra:
+        extra = body_arrays(bodies.extra)
+        for name, data in RANGE_DATA.items():
+            extra[name] = extra[name]+len(arrays[data])
+        arrays = {name : np.concatenate((arrays[name], extra[name])) for name in arrays}
+    return arrays
+
+# Канонический хэш содержимого сцены (тела, преобразования, материалы, источники) без камеры,
+# а при заданной eye - вместе с параметрами этой камеры
+# Загруженная сцена и та же сцена в памяти дают один хэш: обе приводятся к одним массивам,
+# причём загруженная - без создания тел; сцены с телами неизвестных файлу типов хэшируются
+# по pickle состояний тел без кэшей
+# Хэш содержимого хранится в сцене до invalidate или изменения материалов, преобразований тел,
+# числа тел и источников
+def content_hash(scene : Scene, eye = None):
+    lights = scene.lights
+    key = (Material.changes, Body.moves, len(scene.bodies), lights.positions.tobytes(), lights.intensities.tobytes(), lights.radii.tobytes())
+    if scene.hash_cache is None or scene.hash_cache[0] != key:
+        scene.hash_cache = (key, scene_digest(scene, lights))
+    if eye is None:
+        return scene.hash_cache[1]
+    digest = hashlib.sha256(scene.hash_cache[1].encode())
+    digest.update(json.dumps([eye.fov, eye.shadows, eye.max_depth, eye.cutoff, np.dtype(eye.dtype).str]).encode())
+    digest.update(np.ascontiguousarray(eye.transform).tobytes())
+    return digest.hexdigest()
+
+def scene_digest(scene : Scene, lights : Lights):
+    digest = hashlib.sha256()
+    try:
+        if isinstance(scene.bodies, BodyTable):
+            arrays = table_arrays(scene.bodies)
+        else:
+            arrays = body_arrays(scene.bodies)
+        # Пустой отрезок не зависит от того, где тело оказалось в массивах данных
+        for name in RANGE_DATA:
+            arrays[name][arrays[name][:,0] == arrays[name][:,1]] = 0
+        arrays.update(light_positions = lights.positions, light_intensities = lights.intensities, light_radii = lights.radii)
+        for name in sorted(arrays):
+            array = np.ascontiguousarray(arrays[name])
+            digest.update(f'{name}:{array.dtype.str}:{array.shape}'.encode())
+            digest.update(array.tobytes())
+    except ValueError:
+        digest.update(pickle.dumps(([body_state(b) for b in scene.bodies], scene.light)))
+    return digest.hexdigest()
+
+# Состояние тела для хэша: атрибуты без кэшей и без данных, выводимых из матрицы преобразования
+def body_state(body):
+    state = {name : value for name, value in vars(body).items()
+             if not name.endswith('_cache') and name not in ('shared', 'inv_transform', 'normal_matrix')}
+    return type(body).__qualname__, sorted(state.items())
+
+# Загрузка сцены: тела создаются лениво из отображённых массивов при первом обращении к ним
+# Массивы можно записать и напрямую через write_container - обязательны types и transforms,
+# остальные имеют значения по умолчанию (без bounds все тела создаются при построении иерархии)
+def load_scene(path):
+    arrays, meta = read_container(path)
+    lights = Lights([PointSource(Vec4(np.array(p, float)), Colour.RGB(*i), r)
+                     for p, i, r in zip(arrays.get('light_positions', ()), arrays.get('light_intensities', ()),
+                                        arrays.get('light_radii', ()))])
+    camera = None
+    if 'camera' in arrays:
+        transform, inverse = np.array(arrays['camera'])
+        camera = Eye(meta['camera']['fov'], Mat4(transform, inverse))
+        for key in ('shadows', 'max_depth', 'cutoff'):
+            setattr(camera, key, meta['camera'][key])
+    return Scene(BodyTable(arrays, meta.get('body_types', BODY_TYPES)), lights, camera)
+
+
+
+# Ленивый список тел над массивами файла сцены
+# Тело создаётся при первом обращении и дальше хранится; границы и отражающая способность
+# отдаются массивами без создания тел, с учётом уже созданных тел, которые могли измениться
+class BodyTable:
+    arrays : dict
+    created : dict
+    extra : list
+
+    def __init__(self, arrays, body_types = BODY_TYPES):
+        self.arrays = arrays
+        self.body_types = list(body_types)
+        self.makers = [getattr(self, 'make_'+name.lower()) for name in body_types]
+        self.created = {}
+        # Тела, добавленные в сцену после загрузки
+        self.extra = []
+
+    def __len__(self):
+        return len(self.arrays['types'])+len(self.extra)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        n = len(self.arrays['types'])
+        if i >= n:
+            return self.extra[i-n]
+        body = self.created.get(i)
+        if body is None:
+            body = self.created[i] = self.make(i)
+        return body
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __iadd__(self, bodies):
+        self.extra += list(bodies)
+        return self
+
+    def get(self, name, i, default = None):
+        array = self.arrays.get(name)
+        return default if array is None else array[i]
+
+    def part(self, name, i, data):
+        ranges = self.arrays.get(name)
+        if ranges is None:
+            return self.arrays[data][:0]
+        start, end = ranges[i]
+        return self.arrays[data][start:end]
+
+    def make(self, i):
+        inverse = self.get('inverses', i)
+        transform = Mat4(np.array(self.arrays['transforms'][i]), None if inverse is None else np.array(inverse))
+        body = self.makers[self.arrays['types'][i]](i, transform)
+        colour = self.get('colours', i)
+        colour = None if colour is None or np.any(np.isnan(colour)) else Colour.RGB(*colour)
+        # Новый материал собирается целиком: изменения атрибутов учитываются в Material.changes,
+        # и создание тела по записанным значениям пересобирало бы таблицу материалов сцены
+        body.material = Material(colour, float(self.get('reflectivity', i, 0.0)), *map(float, self.get('phong', i, PHONG)))
+        body.casting_shadow(bool(self.get('shadows', i, True)))
+        return body
+
+    def make_sphere(self, i, transform):
+        return Sphere(transform = transform)
+
+    def make_box(self, i, transform):
+        return Box(transform = transform)
+
+    def make_quad(self, i, transform):
+        points = self.part('vertex_range', i, 'vertices')
+        return Quad(np.array(points), transform) if len(points) else Quad(transform = transform)
+
+    def make_triangle(self, i, transform):
+        return Triangle(np.array(self.part('vertex_range', i, 'vertices')), transform)
+
+    def make_polyhedron(self, i, transform):
+        return Polyhedron(self.part('vertex_range', i, 'vertices'), self.part('face_range', i, 'faces'), transform)
+
+    def make_spherefield(self, i, transform):
+        palette = self.part('palette_range', i, 'palettes')
+        start, end = self.arrays['field_range'][i]
+        return SphereField(self.arrays['field_centres'][start:end], self.arrays['field_radii'][start:end],
+                           self.arrays['field_colours'][start:end], palette if len(palette) else None, transform)
+
+    # Созданные тела, преобразование или материал которых отличаются от записанных в файле: пары (номер, тело)
+    def changes(self):
+        result = []
+        for i, body in sorted(self.created.items()):
+            colour = np.full(3, np.nan) if body.colour is None else body.colour.data[:3]
+            same = (np.array_equal(body.transform, self.arrays['transforms'][i])
+                    and np.array_equal(colour, self.get('colours', i, np.full(3, np.nan)), equal_nan = True)
+                    and body.material.reflectivity == self.get('reflectivity', i, 0.0)
+                    and np.array_equal(body.material.phong(), self.get('phong', i, PHONG))
+                    and body.casts_shadow == self.get('shadows', i, True))
+            if not same:
+                result.append((i, body))
+        return result
+
+    # Мировые границы (B,2,3) всех тел
+    def world_bounds(self):
+        if 'bounds' not in self.arrays:
+            return np.array([b.world_bounds() for b in self]).reshape((-1, 2, 3))
+        bounds = np.array(self.arrays['bounds'])
+        for i, body in self.created.items():
+            bounds[i] = body.world_bounds()
+        return np.concatenate((bounds, np.array([b.world_bounds() for b in self.extra]).reshape((-1, 2, 3))))
+
+    # Таблица материалов всех тел по массивам файла, не создающая тел: у полей сфер с палитрой
+    # по строке на цвет палитры; строки уже созданных тел берутся из их материалов
+    def material_table(self):
+        n = len(self.arrays['types'])
+        colours = np.full((n, 3), np.nan)
+        if 'colours' in self.arrays:
+            colours[:] = self.arrays['colours']
+        reflectivity = np.zeros(n)
+        if 'reflectivity' in self.arrays:
+            reflectivity[:] = self.arrays['reflectivity']
+        phong = np.tile(PHONG, (n, 1))
+        if 'phong' in self.arrays:
+            phong[:] = self.arrays['phong']
+        fields = []
+        if 'SphereField' in self.body_types:
+            fields = np.nonzero(np.asarray(self.arrays['types']) == self.body_types.index('SphereField'))[0]
+        palettes = {i : self.part('palette_range', i, 'palettes') for i in fields}
+        counts = np.ones(n, int)
+        for i, palette in palettes.items():
+            counts[i] = max(1, len(palette))
+        offsets = np.cumsum(counts)-counts
+        colours, phong, reflectivity = (np.repeat(a, counts, axis = 0) for a in (colours, phong, reflectivity))
+        for i, palette in palettes.items():
+            if len(palette):
+                colours[offsets[i]:offsets[i]+len(palette)] = palette
+        for i, body in self.created.items():
+            rows = MaterialTable.of(body.materials())
+            part = slice(offsets[i], offsets[i]+len(rows))
+            colours[part], phong[part], reflectivity[part] = rows.colours, rows.phong, rows.reflectivity
+        return MaterialTable(colours, phong, reflectivity, offsets).join(MaterialTable.of_bodies(self.extra))
+
+
+
+# Потоковый импорт сетки из файла Wavefront OBJ: Polyhedron с вершинами v и гранями f
+# Файл читается частями примерно по chunk байтов, вершины и грани каждой части разбираются
+# массивами и дописываются в растущие буферы; многоугольные грани разбиваются веером на треугольники,
+# ссылки на текстурные координаты и нормали (v/vt/vn) отбрасываются, отрицательные индексы
+# отсчитываются от последней прочитанной вершины
+def load_obj(path, transform = None, chunk = 1 << 22):
+    vertices = Buffer((0, 3), float)
+    faces = Buffer((0, 3), np.int64)
+    refs = re.compile(rb'/\S*')
+    with open(path, 'rb') as f:
+        while True:
+            lines = f.readlines(chunk)
+            if not lines:
+                break
+            is_vertex = np.array([l.startswith(b'v ') for l in lines], bool)
+            is_face = np.array([l.startswith(b'f ') for l in lines], bool)
+            # Число вершин, прочитанных к каждой строке, для отрицательных индексов
+            seen = len(vertices)+np.cumsum(is_vertex)
+            vertex_lines = [lines[k] for k in np.nonzero(is_vertex)[0]]
+            if vertex_lines:
+                vertices.append(np.array([l.split()[1:4] for l in vertex_lines], float))
+            face_idx = np.nonzero(is_face)[0]
+            if len(face_idx):
+                text = refs.sub(b'', b'\n'.join(lines[k][2:].strip() for k in face_idx)).split(b'\n')
+                sizes = np.array([len(l.split()) for l in text])
+                corners = np.array(b' '.join(text).split(), np.int64)
+                corners = np.where(corners < 0, np.repeat(seen[face_idx], sizes)+corners, corners-1)
+                faces.append(fan(corners, sizes))
+    return Polyhedron(vertices.array(), faces.array(), transform)
+
+# Разбиение веером граней с вершинами corners, идущими подряд по sizes вершин на грань
+def fan(corners, sizes):
+    starts = np.cumsum(sizes)-sizes
+    counts = np.maximum(sizes-2, 0)
+    first = np.repeat(starts, counts)
+    k = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)+1
+    return np.stack((corners[first], corners[first+k], corners[first+k+1]), axis = 1)
+
+# Растущий массив: место удваивается при нехватке, так что дописывание частей в среднем линейно
+class Buffer:
+    def __init__(self, shape, dtype):
+        self.data = np.empty(shape, dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, part):
+        if self.size+len(part) > len(self.data):
+            grown = np.empty((max(2*len(self.data), self.size+len(part)),)+self.data.shape[1:], self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:self.size+len(part)] = part
+        self.size += len(part)
+
+    def array(self):
+        return self.data[:self.size]
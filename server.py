@@ -0,0 +1,318 @@
+from optics import Eye
+from scene import Scene
+from scenefile import content_hash, detached
+
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import asyncio
+import itertools
+import numpy as np
+import os
+import pickle
+import struct
+import time
+
+
+
+# Кэш готовых кадров на диске: файлы .npy в каталоге directory, имя файла - ключ кадра
+# Общий размер файлов не превышает capacity байт, первыми удаляются давно не запрошенные кадры;
+# порядок использования хранится во времени изменения файлов и переживает перезапуск
+class ImageCache:
+    directory : str
+    capacity : int
+
+    def __init__(self, directory, capacity = 1 << 30):
+        self.directory = directory
+        self.capacity = capacity
+        os.makedirs(directory, exist_ok = True)
+        # Ключ -> размер файла, от давно использованных к недавним
+        self.entries = OrderedDict()
+        files = [entry for entry in os.scandir(directory) if entry.name.endswith('.npy')]
+        for entry in sorted(files, key = lambda entry: entry.stat().st_mtime):
+            self.entries[entry.name[:-4]] = entry.stat().st_size
+        self.size = sum(self.entries.values())
+        self.evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def path(self, key):
+        return os.path.join(self.directory, key+'.npy')
+
+    # Кадр по ключу или None
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        try:
+            image = np.load(self.path(key))
+            os.utime(self.path(key))
+        except OSError:
+            # Файл удалили в обход кэша
+            self.size -= self.entries.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return image
+
+    # Запись файла кадра без изменения списка записей - её можно вынести в отдельный поток,
+    # а затем учесть файл через add
+    def write(self, key, image):
+        temp = self.path(key)+'.tmp'
+        with open(temp, 'wb') as f:
+            np.save(f, image)
+        os.replace(temp, self.path(key))
+        return os.path.getsize(self.path(key))
+
+    def add(self, key, size):
+        self.size -= self.entries.pop(key, 0)
+        self.entries[key] = size
+        self.size += size
+        self.evict()
+
+    def put(self, key, image):
+        self.add(key, self.write(key, image))
+
+    def evict(self):
+        while self.size > self.capacity and self.entries:
+            key, size = self.entries.popitem(last = False)
+            self.size -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+# Отрисовка в процессе исполнителя
+def render_image(eye : Eye, scene : Scene, width, height):
+    return eye.render(scene, width, height)
+
+# Задание сервера: один кадр, который ждут waiters запросов
+class RenderJob:
+    key : str
+    priority : int
+    # 'queued', 'running' или 'cancelled'
+    state : str
+
+    def __init__(self, key, eye, scene, width, height, priority, future):
+        self.key = key
+        self.eye = eye
+        self.scene = scene
+        self.width = width
+        self.height = height
+        self.priority = priority
+        self.future = future
+        self.state = 'queued'
+        self.waiters = 0
+        self.queued = time.perf_counter()
+
+# Асинхронный сервер отрисовки: кадры (сцена, камера, разрешение) считаются в пуле из workers процессов,
+# а готовые изображения попадают в ImageCache в каталоге directory
+# Ключ кадра - content_hash сцены с параметрами камеры и разрешение, поэтому одинаковые запросы
+# выполняются один раз: повторный берётся из кэша, а пришедший во время отрисовки ждёт то же задание
+# Задания выполняются по убыванию priority; задание, которое перестали ждать все запросы, снимается
+# из очереди, а уже начатое досчитывается и попадает в кэш
+class RenderServer:
+    # Сколько последних заданий учитывается в задержке очереди и времени отрисовки
+    history = 1000
+
+    def __init__(self, directory, workers = None, capacity = 1 << 30, executor = None):
+        self.cache = ImageCache(directory, capacity)
+        self.workers = workers or os.cpu_count()
+        self.executor = executor
+        self.own_executor = executor is None
+        # Ключ -> задание в очереди или в работе
+        self.jobs = {}
+        self.queue = None
+        self.runners = []
+        self.order = itertools.count()
+        self.requests = 0
+        self.hits = 0
+        self.deduplicated = 0
+        self.cancelled = 0
+        self.rendered = 0
+        self.failed = 0
+        self.latencies = deque(maxlen = self.history)
+        self.render_times = deque(maxlen = self.history)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        self.queue = asyncio.PriorityQueue()
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        # Заданий в работе не больше, чем исполнителей: остальные ждут в очереди с приоритетами
+        self.runners = [asyncio.ensure_future(self.run()) for _ in range(self.workers)]
+
+    async def close(self):
+        for runner in self.runners:
+            runner.cancel()
+        await asyncio.gather(*self.runners, return_exceptions = True)
+        self.runners = []
+        for job in self.jobs.values():
+            job.future.cancel()
+        self.jobs = {}
+        if self.own_executor and self.executor is not None:
+            self.executor.shutdown(wait = False)
+            self.executor = None
+
+    def key(self, eye, scene, width, height):
+        return f'{content_hash(scene, eye)}-{width}x{height}'
+
+    # Изображение (height, width, 3) в байтах
+    # Сцену и камеру нельзя менять, пока запрос не выполнен: ключ кадра считается при его поступлении
+    async def render(self, eye : Eye, scene : Scene, width, height, priority = 0):
+        self.requests += 1
+        # Хэш большой сцены считается долго, поэтому не в цикле событий; повторные запросы
+        # той же неизменённой сцены берут его из scene.hash_cache
+        key = await asyncio.get_running_loop().run_in_executor(None, self.key, eye, scene, width, height)
+        job = self.jobs.get(key)
+        if job is not None and job.future.done():
+            # Кадр готов, но файл кэша ещё пишется
+            self.hits += 1
+            return job.future.result()
+        if job is None:
+            image = self.cache.get(key)
+            if image is not None:
+                self.hits += 1
+                return image
+            job = RenderJob(key, eye, scene, width, height, priority, asyncio.get_running_loop().create_future())
+            self.jobs[key] = job
+            self.queue.put_nowait((-priority, next(self.order), job))
+        else:
+            self.deduplicated += 1
+            if priority > job.priority and job.state == 'queued':
+                # Старая запись очереди будет пропущена исполнителем
+                job.priority = priority
+                self.queue.put_nowait((-priority, next(self.order), job))
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            job.waiters -= 1
+            if job.waiters == 0 and job.state == 'queued':
+                job.state = 'cancelled'
+                self.cancelled += 1
+                del self.jobs[key]
+                job.future.cancel()
+            raise
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self.queue.get()
+            if job.state != 'queued':
+                continue
+            job.state = 'running'
+            start = time.perf_counter()
+            self.latencies.append(start-job.queued)
+            try:
+                image = await loop.run_in_executor(self.executor, render_image, job.eye, detached(job.scene), job.width, job.height)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.failed += 1
+                job.future.set_exception(error)
+                if job.waiters == 0:
+                    job.future.exception()
+                self.jobs.pop(job.key, None)
+                continue
+            self.render_times.append(time.perf_counter()-start)
+            self.rendered += 1
+            job.future.set_result(image)
+            # Пока файл пишется, задание остаётся в self.jobs и новые запросы получают его результат
+            size = await loop.run_in_executor(None, self.cache.write, job.key, image)
+            self.cache.add(job.key, size)
+            self.jobs.pop(job.key, None)
+
+    # Счётчики сервера: доля запросов из кэша и задержка очереди (от поступления задания до начала отрисовки)
+    # по последним history заданиям, в секундах
+    def metrics(self):
+        latencies = np.array(self.latencies)
+        times = np.array(self.render_times)
+        states = [job.state for job in self.jobs.values()]
+        return {
+            'requests' : self.requests,
+            'hits' : self.hits,
+            'hit_rate' : self.hits/self.requests if self.requests else 0.0,
+            'deduplicated' : self.deduplicated,
+            'cancelled' : self.cancelled,
+            'rendered' : self.rendered,
+            'failed' : self.failed,
+            'queued' : states.count('queued'),
+            'running' : states.count('running'),
+            'queue_latency' : {
+                'mean' : float(latencies.mean()) if len(latencies) else 0.0,
+                'p95' : float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+                'max' : float(latencies.max()) if len(latencies) else 0.0,
+            },
+            'render_time' : float(times.mean()) if len(times) else 0.0,
+            'cache_entries' : len(self.cache),
+            'cache_bytes' : self.cache.size,
+        }
+
+    # Приём заданий по TCP: сообщения - pickle с длиной впереди, как в farm.py, поэтому только для доверенной сети
+    # ('render', eye, scene, width, height, priority) -> ('image', pixels) или ('error', текст)
+    # ('metrics',) -> ('metrics', словарь)
+    async def serve(self, host = '127.0.0.1', port = 0):
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    return
+                if message[0] == 'render':
+                    try:
+                        reply = ('image', await self.render(*message[1:]))
+                    except Exception as error:
+                        reply = ('error', f'{type(error).__name__}: {error}')
+                elif message[0] == 'metrics':
+                    reply = ('metrics', self.metrics())
+                else:
+                    reply = ('error', f'unknown request: {message[0]}')
+                await write_message(writer, reply)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+async def read_message(reader):
+    try:
+        header = await reader.readexactly(8)
+    except asyncio.IncompleteReadError as error:
+        if error.partial:
+            raise
+        return None
+    return pickle.loads(await reader.readexactly(struct.unpack('<Q', header)[0]))
+
+async def write_message(writer, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    writer.write(struct.pack('<Q', len(data))+data)
+    await writer.drain()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Сервер отрисовки с кэшем кадров')
+    parser.add_argument('directory', help = 'каталог кэша кадров')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--capacity', type = int, default = 1 << 30, help = 'размер кэша в байтах')
+    args = parser.parse_args()
+
+    async def main():
+        async with RenderServer(args.directory, args.workers, args.capacity) as server:
+            tcp = await server.serve(args.host, args.port)
+            async with tcp:
+                await tcp.serve_forever()
+
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+import numpy as np
+import struct
+import zlib
+
+
+
+# Приёмник готовых плиток кадра: пиксели плитки rect = (x0, y0, x1, y1) - массив (y1-y0, x1-x0, 3) байтов
+# Позволяет не держать в памяти весь кадр при отрисовке в больших разрешениях
+class Sink:
+    width : int
+    height : int
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def __enter__(self):
+        return self
+
+    # При ошибке внутри with файл освобождается без проверки полноты кадра, и наружу уходит сама ошибка
+    def __exit__(self, kind, error, traceback):
+        if kind is None:
+            self.close()
+        else:
+            self.release()
+
+    def write(self, rect, pixels):
+        pass
+
+    def close(self):
+        pass
+
+    # Освобождение файла незаконченного кадра
+    def release(self):
+        self.close()
+
+# Запись кадра в файл сырых байтов RGB, отображённый в память
+# Плитки пишутся прямо в отображение, а вытеснением страниц на диск занимается система
+class RawSink(Sink):
+    path : str
+    header = b''
+
+    def __init__(self, path, width, height):
+        super().__init__(width, height)
+        self.path = path
+        with open(path, 'wb') as f:
+            f.write(self.get_header())
+            f.truncate(len(self.get_header())+3*width*height)
+        self.pixels = np.memmap(path, np.uint8, 'r+', len(self.get_header()), (height, width, 3))
+
+    def get_header(self):
+        return self.header
+
+    def write(self, rect, pixels):
+        x0, y0, x1, y1 = rect
+        self.pixels[y0:y1, x0:x1] = pixels
+
+    def close(self):
+        if self.pixels is not None:
+            self.pixels.flush()
+            self.pixels = None
+
+# Запись в файл PPM (P6): сырые байты с текстовым заголовком
+class PPMSink(RawSink):
+    def get_header(self):
+        return f'P6\n{self.width} {self.height}\n255\n'.encode()
+
+# Потоковый кодировщик PNG: строки сжимаются и записываются по мере готовности полос плиток
+# Плитки одной полосы должны иметь общие y0 и y1, как у плиток parallel.tiles; полосы могут
+# приходить в любом порядке, но в памяти держатся только ещё не записанные
+class PNGSink(Sink):
+    level : int
+
+    def __init__(self, path, width, height, level = 6):
+        super().__init__(width, height)
+        self.file = open(path, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        # 8 бит на канал, цвет RGB, без чересстрочности
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(level)
+        # Незаписанные полосы: y0 -> (массив полосы, число заполненных пикселей)
+        self.bands = {}
+        self.next_row = 0
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data))+kind+data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind+data) & 0xffffffff))
+
+    def write(self, rect, pixels):
+        x0, y0, x1, y1 = rect
+        band, filled = self.bands.get(y0, (None, 0))
+        if band is None:
+            band = np.empty((y1-y0, self.width, 3), np.uint8)
+        band[:, x0:x1] = pixels
+        self.bands[y0] = (band, filled+(x1-x0)*(y1-y0))
+        # Готовые полосы записываются по порядку строк
+        while self.next_row in self.bands:
+            band, filled = self.bands[self.next_row]
+            if filled < band.shape[0]*self.width:
+                break
+            del self.bands[self.next_row]
+            self.write_rows(band)
+            self.next_row += band.shape[0]
+
+    # Сжатие строк с фильтром Sub: каждый байт заменяется разностью с тем же каналом соседа слева
+    def write_rows(self, rows):
+        rows = rows.reshape((len(rows), -1))
+        filtered = np.empty((len(rows), rows.shape[1]+1), np.uint8)
+        filtered[:,0] = 1
+        filtered[:,1:4] = rows[:,:3]
+        filtered[:,4:] = rows[:,3:]-rows[:,:-3]
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.chunk(b'IDAT', data)
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.next_row < self.height:
+            self.release()
+            raise ValueError(f'PNG is incomplete: {self.next_row} of {self.height} rows written')
+        self.chunk(b'IDAT', self.compressor.flush())
+        self.chunk(b'IEND', b'')
+        self.file.close()
+        self.file = None
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
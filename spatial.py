@@ -44,14 +44,21 @@ class Vec4:
 def reflect_array(a, n):
     return a-n*2*sum(a[:3]*n[:3])
 
+# Отражение массива векторов (...,4) относительно массива нормалей той же или транслируемой формы
+def reflect_arrays(a, n):
+    return a-n*2*np.sum(a[...,:3]*n[...,:3], axis = -1)[...,None]
+
 
 
 # Матрицы
 class Matrix:
     data : np.ndarray
+    # Обратная матрица, если она известна в замкнутом виде, иначе None
+    inverse : np.ndarray
 
-    def __init__(self, array):
+    def __init__(self, array, inverse = None):
         self.data = array
+        self.inverse = inverse
 
     def __repr__(self):
         return f'Matrix:\n{repr(self.data)}'
@@ -59,17 +66,23 @@ class Matrix:
     # Вычисляет определитель
     def __abs__(self):
         return np.linalg.det(self.data)
-    # Вычисляет обратную матрицу
+    # Вычисляет обратную матрицу, известная обратная не пересчитывается
     def __invert__(self):
-        return np.linalg.inv(self.data)
+        return np.linalg.inv(self.data) if self.inverse is None else self.inverse
     def __add__(self, other):
         return type(self)(self.data+other.data)
     def __sub__(self, other):
         return type(self)(self.data-other.data)
+    # Обратная произведения собирается из обратных сомножителей: (AB)^-1 = B^-1 A^-1
     def __mul__(self, other):
-        return type(self)(np.matmul(self.data, other.data))
+        inverse = None
+        if self.inverse is not None and other.inverse is not None:
+            inverse = np.matmul(other.inverse, self.inverse)
+        return type(self)(np.matmul(self.data, other.data), inverse)
     def __imul__(self, other):
-        self.data = (self*other).data
+        result = self*other
+        self.data, self.inverse = result.data, result.inverse
+        return self
 
 # Матрицы 4х4 для трансформаций векторов
 class Mat4(Matrix):
@@ -84,13 +97,17 @@ class Mat4(Matrix):
         array = np.zeros((4, 4))
         for i, v in enumerate((x, y, z, 1)):
             array[i,i] = v
-        return Mat4(array)
+        inverse = None
+        if x != 0 and y != 0 and z != 0:
+            inverse = np.diag((1.0/x, 1.0/y, 1.0/z, 1.0))
+        return Mat4(array, inverse)
 
     # Конструктор матрицы переноса
     def Translator(x = 0, y = 0, z = 0):
         result = Mat4.Identity()
         for i, v in enumerate((x, y, z)):
             result.data[3,i] = v
+            result.inverse[3,i] = -v
         return result
     
     # Конструктор матрицы поворота
@@ -113,6 +130,8 @@ class Mat4(Matrix):
             result.data[1,1] = c
             result.data[0,1] = s
             result.data[1,0] = -s
+        # Матрица поворота ортогональна
+        result.inverse = result.data.T.copy()
         return result
     
     def Shearer(xy = 0, xz = 0, yx = 0,
@@ -124,10 +143,16 @@ class Mat4(Matrix):
         result.data[2,1] = yz
         result.data[0,2] = zx
         result.data[1,2] = zy
+        # Сдвиг вдоль одной пары осей обращается сменой знака коэффициента,
+        # обратная общего сдвига вычисляется по требованию
+        if np.count_nonzero((xy, xz, yx, yz, zx, zy)) <= 1:
+            result.inverse = 2.0*np.identity(4)-result.data
+        else:
+            result.inverse = None
         return result
 
-    def __init__(self, array):
-        super().__init__(array)
+    def __init__(self, array, inverse = None):
+        super().__init__(array, inverse)
     
     # Применяет матричную трансформацию к вектору
     def __rmul__(self, other : Vec4):
@@ -135,12 +160,119 @@ class Mat4(Matrix):
 
 
 
+# Произведение Гамильтона массивов кватернионов (..., 4) с компонентами (w, x, y, z)
+def quat_multiply(a, b):
+    aw, ax, ay, az = np.moveaxis(np.asarray(a), -1, 0)
+    bw, bx, by, bz = np.moveaxis(np.asarray(b), -1, 0)
+    return np.stack((aw*bw-ax*bx-ay*by-az*bz,
+                     aw*bx+ax*bw+ay*bz-az*by,
+                     aw*by-ax*bz+ay*bw+az*bx,
+                     aw*bz+ax*by-ay*bx+az*bw), axis = -1)
+
+def quat_conj(q):
+    return q*np.array((1.0, -1.0, -1.0, -1.0))
+
+# Поворот векторов (..., 4) единичными кватернионами q (4,) или (..., 4), w-компонента векторов сохраняется
+# Вместо двух произведений q v q* используется равносильное v + 2w (u x v) + 2 u x (u x v), u = (x, y, z)
+def quat_rotate(q, vectors):
+    q = np.asarray(q)
+    u = q[...,1:]
+    v = vectors[...,:3]
+    uv = np.cross(u, v)
+    result = np.array(vectors, copy = True)
+    result[...,:3] = v+2.0*(q[...,:1]*uv+np.cross(u, uv))
+    return result
+
+# Логарифм и экспонента единичных кватернионов (..., 4), логарифм - чистый кватернион
+def quat_log(q):
+    v = q[...,1:]
+    norm = np.sqrt(np.sum(v*v, axis = -1, keepdims = True))
+    angle = np.arctan2(norm, q[...,:1])
+    scale = np.where(norm > 1e-12, angle/np.where(norm > 1e-12, norm, 1.0), 1.0)
+    return np.concatenate((np.zeros_like(q[...,:1]), scale*v), axis = -1)
+
+def quat_exp(q):
+    v = q[...,1:]
+    angle = np.sqrt(np.sum(v*v, axis = -1, keepdims = True))
+    scale = np.where(angle > 1e-12, np.sin(angle)/np.where(angle > 1e-12, angle, 1.0), 1.0)
+    return np.concatenate((np.cos(angle), scale*v), axis = -1)
+
+# Сферическая линейная интерполяция единичных кватернионов a, b (..., 4) с параметрами t (...)
+# Из двух представлений b выбирается ближайшее к a, почти совпадающие кватернионы интерполируются линейно
+def slerp(a, b, t):
+    t = np.asarray(t, float)[...,None]
+    dot = np.sum(a*b, axis = -1, keepdims = True)
+    b = np.where(dot < 0.0, -b, b)
+    dot = np.abs(dot)
+    close = dot > 1.0-1e-6
+    angle = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin = np.where(close, 1.0, np.sin(angle))
+    wa = np.where(close, 1.0-t, np.sin((1.0-t)*angle)/sin)
+    wb = np.where(close, t, np.sin(t*angle)/sin)
+    result = wa*a+wb*b
+    return result/np.sqrt(np.sum(result*result, axis = -1, keepdims = True))
+
+# Сферическая кубическая интерполяция между a и b с промежуточными точками sa, sb (squad_controls)
+def squad(a, b, sa, sb, t):
+    t = np.asarray(t, float)
+    return slerp(slerp(a, b, t), slerp(sa, sb, t), 2.0*t*(1.0-t))
+
+# Промежуточные точки squad для последовательности ключевых кватернионов keys (K,4)
+# Соседние ключи приводятся к одной полусфере, крайние ключи служат своими же промежуточными точками
+def squad_controls(keys):
+    keys = np.array(keys, float)
+    for k in range(1, len(keys)):
+        if np.dot(keys[k-1], keys[k]) < 0.0:
+            keys[k] = -keys[k]
+    controls = keys.copy()
+    if len(keys) > 2:
+        q = keys[1:-1]
+        inv = quat_conj(q)
+        logs = quat_log(quat_multiply(inv, keys[2:]))+quat_log(quat_multiply(inv, keys[:-2]))
+        controls[1:-1] = quat_multiply(q, quat_exp(-0.25*logs))
+    return keys, controls
+
+# Матрицы поворота (..., 4, 4) для умножения векторов-строк по единичным кватернионам (..., 4)
+def quat_to_matrices(q):
+    w, x, y, z = np.moveaxis(np.asarray(q, float), -1, 0)
+    result = np.zeros(np.shape(w)+(4, 4))
+    # Строка i - образ i-го базисного вектора
+    result[...,0,0] = 1.0-2.0*(y*y+z*z)
+    result[...,0,1] = 2.0*(x*y+w*z)
+    result[...,0,2] = 2.0*(x*z-w*y)
+    result[...,1,0] = 2.0*(x*y-w*z)
+    result[...,1,1] = 1.0-2.0*(x*x+z*z)
+    result[...,1,2] = 2.0*(y*z+w*x)
+    result[...,2,0] = 2.0*(x*z+w*y)
+    result[...,2,1] = 2.0*(y*z-w*x)
+    result[...,2,2] = 1.0-2.0*(x*x+y*y)
+    result[...,3,3] = 1.0
+    return result
+
+# Единичные кватернионы (..., 4) по поворотным частям матриц (..., 4, 4) для векторов-строк
+# Компонента с наибольшим квадратом считается через след, остальные - через её сумму и разности
+def quat_from_matrices(m):
+    m = np.asarray(m, float)
+    m00, m11, m22 = m[...,0,0], m[...,1,1], m[...,2,2]
+    squares = np.stack((1.0+m00+m11+m22, 1.0+m00-m11-m22, 1.0-m00+m11-m22, 1.0-m00-m11+m22), axis = -1)
+    big = np.argmax(squares, axis = -1)
+    r = 0.5*np.sqrt(np.max(squares, axis = -1))
+    s = 0.25/r
+    # Суммы и разности симметричных элементов дают попарные произведения 4wx, 4xy и т. д.
+    wx, wy, wz = m[...,1,2]-m[...,2,1], m[...,2,0]-m[...,0,2], m[...,0,1]-m[...,1,0]
+    xy, xz, yz = m[...,0,1]+m[...,1,0], m[...,0,2]+m[...,2,0], m[...,1,2]+m[...,2,1]
+    candidates = np.stack((np.stack((r, wx*s, wy*s, wz*s), axis = -1),
+                           np.stack((wx*s, r, xy*s, xz*s), axis = -1),
+                           np.stack((wy*s, xy*s, r, yz*s), axis = -1),
+                           np.stack((wz*s, xz*s, yz*s, r), axis = -1)), axis = -2)
+    result = np.take_along_axis(candidates, big[...,None,None], axis = -2)[...,0,:]
+    # Знак выбирается с неотрицательной w, как у Versor.make при углах до pi
+    return np.where(result[...,:1] < 0.0, -result, result)
+
+
+
 # Верзоры для поворотов векторов
 class Versor:
-    # Вспомогательные массивы индексов и знаков для умножения кватернионов
-    __mul_indices = np.array((0,1,2,3, 1,0,3,2, 2,3,0,1, 3,2,1,0))
-    __mul_signs = np.array((1,1,1,1, 1,-1,1,-1, 1,-1,-1,1, 1,1,-1,-1))
-    
     data : np.ndarray
 
     # Конструктор верзора
@@ -154,6 +286,10 @@ class Versor:
                                 s_coeff*z),
                                float))
 
+    # Верзор поворотной части матрицы преобразования
+    def of_matrix(matrix : Mat4):
+        return Versor(quat_from_matrices(matrix.data))
+
     def __init__(self, array):
         self.data = array
 
@@ -165,35 +301,34 @@ class Versor:
 
     # Вычисляет массив компоннтов сопряжённого кватерниона
     def conj_array(self):
-        return self.data*np.array((1, -1, -1, -1))
+        return quat_conj(self.data)
+
+    # Композиция поворотов: сначала other, затем self
+    def __mul__(self, other):
+        return Versor(quat_multiply(self.data, other.data))
 
     # Применяет кватернионное вращение к вектору
     def __rmul__(self, vector : Vec4):
-        # w-компонента нужна для восстановления вектора исходного типа
-        w = vector.data[3]
-        # Вычисление массива компонентов кватерниона от исходного вектора
-        quat_vec_data = np.concatenate((np.zeros(1), vector.data[:3]))
-        res_quat = self.copy()
-        # Умножение верзора на кватернион точки и сопряжённый верзор
-        res_quat.imul_with_array(quat_vec_data)
-        res_quat.imul_with_array(self.conj_array())
-        # Построение массива компонентов повёрнутого вектора
-        res_array = np.concatenate((res_quat.data[1:], np.array((w,))))
-        return Vec4(res_array)
+        return Vec4(quat_rotate(self.data, vector.data))
+
+    # Поворот массива векторов (..., 4) одной операцией над массивами
+    def rotate(self, vectors):
+        return quat_rotate(self.data, vectors)
+
+    # Матрица поворота с известной обратной - транспонированной
+    def matrix(self):
+        data = quat_to_matrices(self.data)
+        return Mat4(data, data.T.copy())
 
     # Умножает верзор на другой кватернион по его массиву компонентов
     def imul_with_array(self, array):
-        res_table = np.outer(self.data, array)
-        self.data = np.zeros(4)
-        for v, i, s in zip(res_table.flat, self.__mul_indices, self.__mul_signs):
-            self.data[i] += v*s
+        self.data = quat_multiply(self.data, array)
 
 
 
 # Класс лучей
 class Ray:
     data : np.ndarray
-    fields = ('origin', 'direction')
 
     # Конструктор из массивов источника и направления
     def make(origin, direction):
@@ -201,9 +336,14 @@ class Ray:
     
     def __init__(self, array):
         self.data = array
-    
-    def __getattr__(self, attr):
-        return self.data[self.fields.index(attr)]
+
+    @property
+    def origin(self):
+        return self.data[0]
+
+    @property
+    def direction(self):
+        return self.data[1]
     
     def __mul__(self, other : Mat4):
         return Ray(np.matmul(self.data, other.data))
@@ -212,10 +352,14 @@ class Ray:
     def loc_at_t(self, t):
         return self.origin+t*self.direction
 
-    # Поиск ближайшего пересечения с объектами сцены
+    # Поиск ближайшего пересечения с объектами сцены через её иерархию объёмов
     def cast_into(self, scene):
+        return scene.cast(self)
+
+    # Поиск ближайшего пересечения полным перебором тел
+    def cast_into_all(self, bodies):
         result = []
-        for b in scene.bodies:
+        for b in bodies:
             result += b.intersect(self)
         return self.find_hit(result)
 
@@ -229,13 +373,76 @@ class Ray:
 
     # Нормализация
     def normalised(self):
-        self.data[1,:] *= 1.0/np.linalg.norm(self.data[1,:])
+        self.data[1,:] *= 1.0/math.sqrt(np.sum(self.data[1,:]*self.data[1,:]))
+        return self
+
+# Пакет лучей - структура массивов источников и направлений (N,4)
+class RayBatch:
+    origins : np.ndarray
+    directions : np.ndarray
+
+    # Конструктор из массивов источников и направлений
+    # Одиночный источник (4,) растягивается на все лучи
+    # Точность массивов берётся из аргументов, но не ниже float32
+    def make(origins, directions):
+        directions, origins = np.asarray(directions), np.asarray(origins)
+        dtype = np.result_type(directions.dtype, origins.dtype, np.float32)
+        directions = np.ascontiguousarray(directions, dtype)
+        origins = np.ascontiguousarray(np.broadcast_to(origins, directions.shape), dtype)
+        return RayBatch(origins, directions)
+
+    # Конструктор из списка одиночных лучей
+    def of_rays(rays):
+        data = np.array([r.data for r in rays]).reshape((-1, 2, 4))
+        return RayBatch(data[:,0].copy(), data[:,1].copy())
+
+    def __init__(self, origins, directions):
+        self.origins = origins
+        self.directions = directions
+
+    def __repr__(self):
+        return f'RayBatch:{len(self)} rays'
+
+    def __len__(self):
+        return len(self.origins)
+
+    @property
+    def dtype(self):
+        return self.origins.dtype
+
+    # Пакет в точности dtype, при совпадающей точности - он сам
+    def astype(self, dtype):
+        if np.dtype(dtype) == self.dtype:
+            return self
+        return RayBatch(self.origins.astype(dtype), self.directions.astype(dtype))
+
+    # Выборка подпакета по маске или массиву индексов
+    def __getitem__(self, index):
+        return RayBatch(self.origins[index], self.directions[index])
+
+    # Одиночный луч пакета
+    def ray(self, i):
+        return Ray.make(self.origins[i], self.directions[i])
+
+    def __mul__(self, other):
+        matrix = other.data if isinstance(other, Matrix) else other
+        return RayBatch(np.matmul(self.origins, matrix), np.matmul(self.directions, matrix))
+
+    # Точки на лучах для массива параметров t (N,)
+    def loc_at_t(self, t):
+        return self.origins+t[:,None]*self.directions
+
+    # Нормализация направлений
+    def normalised(self):
+        self.directions /= np.sqrt(np.sum(self.directions*self.directions, axis = 1))[:,None]
         return self
 
 # Структура для хранения информации о пересечении
 class Intersection:
     t : float
+    face : int
 
-    def __init__(self, t, body):
+    def __init__(self, t, body, face = -1):
         self.t = t
         self.body = body
+        self.face = face
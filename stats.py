@@ -0,0 +1,94 @@
+from contextlib import contextmanager, nullcontext
+import numpy as np
+import time
+
+
+
+# Статистика отрисовки: счётчики лучей и проверок пересечений, время стадий и плиток
+class RenderStats:
+    width : int
+    height : int
+    rays : dict
+    hits : dict
+    tests : dict
+    times : dict
+    tiles : list
+
+    def __init__(self, width = 0, height = 0):
+        self.width = width
+        self.height = height
+        # Лучи, попадания и проверки считаются по видам лучей и типам тел
+        self.rays = {}
+        self.hits = {}
+        self.tests = {}
+        self.times = {}
+        # Пары (rect, секунды) для каждой отрисованной плитки
+        self.tiles = []
+
+    def __repr__(self):
+        return f'RenderStats:{self.summary()}'
+
+    # Учёт пакета лучей вида kind ('primary', 'reflection', 'shadow') и числа попаданий в нём
+    def count_rays(self, kind, n, hits):
+        self.rays[kind] = self.rays.get(kind, 0)+n
+        self.hits[kind] = self.hits.get(kind, 0)+hits
+
+    # Учёт n проверок пересечения луча с телом body
+    def count_tests(self, body, n):
+        name = type(body).__name__
+        self.tests[name] = self.tests.get(name, 0)+n
+
+    # Замер времени стадии
+    @contextmanager
+    def timer(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[stage] = self.times.get(stage, 0.0)+time.perf_counter()-t0
+
+    def add_tile(self, rect, seconds):
+        self.tiles.append((tuple(rect), seconds))
+
+    # Доля попаданий среди лучей вида kind
+    def hit_ratio(self, kind = 'primary'):
+        rays = self.rays.get(kind, 0)
+        return self.hits.get(kind, 0)/rays if rays else 0.0
+
+    # Объединение со статистикой другого процесса или плитки
+    def merge(self, other):
+        for mine, theirs in ((self.rays, other.rays), (self.hits, other.hits),
+                             (self.tests, other.tests), (self.times, other.times)):
+            for key, value in theirs.items():
+                mine[key] = mine.get(key, 0)+value
+        self.tiles += other.tiles
+        return self
+
+    def summary(self):
+        return {'rays' : dict(self.rays),
+                'hit_ratio' : {kind : self.hit_ratio(kind) for kind in self.rays},
+                'tests' : dict(self.tests),
+                'times' : dict(self.times),
+                'tiles' : len(self.tiles)}
+
+    # Тепловая карта стоимости плиток: от чёрного (дешёвые) через красный к жёлтому (дорогие)
+    def heatmap(self):
+        cost = np.zeros((self.height, self.width))
+        for (x0, y0, x1, y1), seconds in self.tiles:
+            cost[y0:y1, x0:x1] = seconds/max(1, (x1-x0)*(y1-y0))
+        if cost.max() > 0.0:
+            cost /= cost.max()
+        image = np.zeros((self.height, self.width, 3))
+        image[...,0] = np.clip(2.0*cost, 0.0, 1.0)
+        image[...,1] = np.clip(2.0*cost-1.0, 0.0, 1.0)
+        return (255.0*image).astype(np.uint8)
+
+    def save_heatmap(self, path):
+        from PIL import Image
+        Image.fromarray(self.heatmap()).save(path)
+
+
+
+# Замер стадии, если статистика включена; без неё - пустой контекст
+def timed(stats, stage):
+    return nullcontext() if stats is None else stats.timer(stage)
@@ -1,5 +1,21 @@
+import numpy as np
+
 EPSILON = 1e-8
+# Сдвиг начала вторичных лучей вдоль нормали, защищающий от самопересечения с поверхностью
+OFFSET = 1e-6
+
+# Допуск сравнения и сдвиг вторичных лучей для каждой точности вычислений
+# У float32 около семи значащих цифр, так что погрешность точек пересечения
+# на масштабах сцены в десятки единиц достигает 1e-5 и сдвиг нужен больше
+TOLERANCES = {np.dtype(np.float64) : (EPSILON, OFFSET),
+              np.dtype(np.float32) : (1e-6, 1e-4)}
+
+def epsilon(dtype = np.float64):
+    return TOLERANCES[np.dtype(dtype)][0]
+
+def offset(dtype = np.float64):
+    return TOLERANCES[np.dtype(dtype)][1]
 
 # Проверяет равенство чисел с плаваюей точкой
-def floeq(a, b):
-    return abs(a-b) < EPSILON
+def floeq(a, b, eps = EPSILON):
+    return abs(a-b) < eps